@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of the build and simulation stages: build.py and
+# simulate.py (or pipeline.py) run unchanged against a synthetic Zephyr tree,
+# with west and Renode replaced by the stand-ins from scripts/standins, which
+# sleep, hold memory, fail and print their output as a latency profile says.
+# It needs the Python requirements of both stages, but no Zephyr, toolchains
+# or Renode, so changes to scheduling, caching and parallelism can be compared
+# on any Linux box.
+#
+#   BENCH_BOARDS    number of synthetic boards (300)
+#   BENCH_SEED      seed of the boards and of their latencies (0)
+#   BENCH_PROFILE   JSON file overriding the latency profile, see standins/latency.py
+#   BENCH_MODE      'separate' runs build.py and then simulate.py, 'pipeline' pipeline.py
+#   BENCH_RUNS      number of runs, every run gets the artifacts of the one
+#                   before as PREVIOUS_ARTIFACTS, like in CI (1)
+#   BENCH_DIR       where the tree, the artifacts and the report go (benchmark)
+#
+# Everything else (NUMBER_OF_THREADS, SAMPLE_NAME, SIM_JOBS, BUILD_CACHE, ...)
+# is passed to the stages as it is. Makespan, throughput and peak memory of
+# every stage are printed and saved to <BENCH_DIR>/benchmark.json.
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from colorama import init
+init()
+
+from colorama import Fore, Style
+
+import cache
+from standins import latency
+
+def bold(text):
+    return Style.BRIGHT + (text or '') + Style.RESET_ALL
+
+def red(text):
+    return Fore.RED + (text or '') + Style.RESET_ALL
+
+def green(text):
+    return Fore.GREEN + (text or '') + Style.RESET_ALL
+
+scripts_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(scripts_dir)
+board_count = int(os.getenv('BENCH_BOARDS', 300))
+seed = os.getenv('BENCH_SEED', '0')
+mode = os.getenv('BENCH_MODE', 'separate')
+run_count = int(os.getenv('BENCH_RUNS', 1))
+bench_dir = os.path.realpath(os.getenv('BENCH_DIR', 'benchmark'))
+zephyr_path = 'zephyrproject/zephyr'
+# the memory of the stage and all its processes is summed this often, in seconds
+memory_interval = 0.2
+# settings of the stages recorded with the results
+knobs = ('NUMBER_OF_THREADS', 'SAMPLE_NAME', 'SIM_JOBS', 'BUILD_JOBS', 'NINJA_JOBS', 'BUILD_SCHEDULER',
+         'BUILD_CPU_OVERCOMMIT', 'BUILD_CACHE', 'SPDX', 'SPDX_JOBS', 'PREFILTER', 'RENODE_BATCH_SIZE',
+         'SIM_TIMEOUT', 'SIM_CACHE', 'DTS2REPL_CACHE', 'ARTIFACT_STORE', 'ZIP_JOBS', 'ZIP_COMPRESSION',
+         'SHARD_COUNT', 'SHARD_INDEX', 'TRACE', 'SAMPLE_INTERVAL')
+
+# architectures of the synthetic boards with their CPUs and how common they are
+archs = (
+    ('arm', ('arm,cortex-m0+', 'arm,cortex-m3', 'arm,cortex-m4f', 'arm,cortex-m33'), 60),
+    ('riscv', ('riscv,rv32imac', 'sifive,e31'), 20),
+    ('xtensa', ('cdns,tensilica-xtensa-lx6',), 10),
+    ('x86', ('intel,x86',), 5),
+    ('sparc', ('gaisler,leon3',), 3),
+    ('mips', ('mips,m4k',), 2),
+)
+flash_sizes = (64, 128, 256, 512, 1024)
+# share of the boards without a console, which can't be simulated
+no_uart_rate = 0.05
+
+board_dts_template = '''/dts-v1/;
+
+/ {{
+	model = "{full_name}";
+	compatible = "bench,{name}";
+
+	chosen {{
+{chosen}		zephyr,sram = &sram0;
+		zephyr,flash = &flash0;
+	}};
+
+	cpus {{
+		#address-cells = <1>;
+		#size-cells = <0>;
+
+		cpu0: cpu@0 {{
+			device_type = "cpu";
+			compatible = "{cpu}";
+			reg = <0>;
+		}};
+	}};
+
+	soc {{
+		#address-cells = <1>;
+		#size-cells = <1>;
+
+		sram0: memory@20000000 {{
+			compatible = "mmio-sram";
+			reg = <0x20000000 {sram_size:#x}>;
+		}};
+
+		flash0: flash@0 {{
+			compatible = "soc-nv-flash";
+			reg = <0x0 {flash_size:#x}>;
+		}};
+{uart}	}};
+}};
+'''
+
+board_uart = '''
+		uart0: serial@40002000 {
+			compatible = "ns16550";
+			reg = <0x40002000 0x1000>;
+			status = "okay";
+		};
+'''
+
+board_yaml_template = '''identifier: {name}
+name: {full_name}
+type: mcu
+arch: {arch}
+toolchain:
+  - zephyr
+  - gnuarmemb
+ram: {ram_kb}
+flash: {flash_kb}
+'''
+
+# the part of the Zephyr board listing build.py uses
+list_boards_script = '''import collections
+import os
+
+Board = collections.namedtuple('Board', 'name arch dir')
+
+def find_arch2boards(args):
+    arch2boards = {}
+    for board_root in args.board_roots:
+        boards_dir = board_root / 'boards'
+        for arch in sorted(os.listdir(boards_dir)):
+            for name in sorted(os.listdir(boards_dir / arch)):
+                arch2boards.setdefault(arch, []).append(Board(name, arch, boards_dir / arch / name))
+    return arch2boards
+'''
+
+def run_git(*args):
+    # a fixed identity and date, so that the same boards give the same commit
+    env = dict(os.environ, GIT_AUTHOR_NAME='benchmark', GIT_AUTHOR_EMAIL='benchmark@localhost',
+               GIT_COMMITTER_NAME='benchmark', GIT_COMMITTER_EMAIL='benchmark@localhost',
+               GIT_AUTHOR_DATE='2023-01-01T00:00:00Z', GIT_COMMITTER_DATE='2023-01-01T00:00:00Z')
+    subprocess.run(['git'] + list(args), cwd=os.path.join(bench_dir, zephyr_path), env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+def generate_boards():
+    rng = random.Random(f'{seed}:boards')
+    boards = []
+    for i in range(board_count):
+        arch, cpus, _ = rng.choices(archs, weights=[weight for _, _, weight in archs])[0]
+        boards.append({
+            'name': f'bench_{arch}_{i:04d}',
+            'full_name': f'Benchmark {arch.upper()} board {i}',
+            'arch': arch,
+            'cpu': rng.choice(cpus),
+            'flash_kb': rng.choice(flash_sizes),
+            'uart': rng.random() >= no_uart_rate,
+        })
+    return boards
+
+def generate_zephyr_tree():
+    # the tree is kept between benchmarks with the same boards, so that the
+    # board index of build.py can be reused like on a CI runner
+    tree_info = {'boards': board_count, 'seed': seed,
+                 'templates': cache.hash_data(board_dts_template, board_uart, board_yaml_template, list_boards_script)}
+    info_filename = os.path.join(bench_dir, 'zephyr-tree.json')
+    if os.path.exists(info_filename):
+        with open(info_filename) as f:
+            if json.load(f) == tree_info:
+                return
+    shutil.rmtree(os.path.join(bench_dir, 'zephyrproject'), ignore_errors=True)
+    shutil.rmtree(os.path.join(bench_dir, 'board_index'), ignore_errors=True)
+
+    zephyr_dir = os.path.join(bench_dir, zephyr_path)
+    os.makedirs(os.path.join(zephyr_dir, 'scripts'))
+    with open(os.path.join(zephyr_dir, 'scripts', 'list_boards.py'), 'w') as f:
+        f.write(list_boards_script)
+    for _, sample_path in (('hello_world', 'hello_world'), ('shell_module', 'subsys/shell/shell_module'), ('philosophers', 'philosophers')):
+        os.makedirs(os.path.join(zephyr_dir, 'samples', sample_path, 'src'))
+        with open(os.path.join(zephyr_dir, 'samples', sample_path, 'src', 'main.c'), 'w') as f:
+            f.write('int main(void)\n{\n\treturn 0;\n}\n')
+    for board in generate_boards():
+        board_dir = os.path.join(zephyr_dir, 'boards', board['arch'], board['name'])
+        os.makedirs(board_dir)
+        with open(os.path.join(board_dir, f"{board['name']}.yaml"), 'w') as f:
+            f.write(board_yaml_template.format(ram_kb=board['flash_kb'] // 4, **board))
+        with open(os.path.join(board_dir, f"{board['name']}.dts"), 'w') as f:
+            f.write(board_dts_template.format(
+                name=board['name'],
+                full_name=board['full_name'],
+                cpu=board['cpu'],
+                flash_size=board['flash_kb'] * 1024,
+                sram_size=board['flash_kb'] * 1024 // 4,
+                chosen='\t\tzephyr,console = &uart0;\n' if board['uart'] else '',
+                uart=board_uart if board['uart'] else '',
+            ))
+    run_git('init', '-q')
+    run_git('add', '.')
+    run_git('commit', '-q', '-m', f'Synthetic tree of {board_count} boards')
+    with open(info_filename, 'w') as f:
+        json.dump(tree_info, f)
+    print(f"Generated a Zephyr tree of {bold(str(board_count))} boards")
+
+def link(src, dest):
+    if not os.path.lexists(dest):
+        os.symlink(src, dest)
+
+def prepare_bench_dir():
+    # laid out like the root of this repository, with the stand-ins in place
+    # of the west on PATH and of renode_portable
+    os.makedirs(os.path.join(bench_dir, 'bin'), exist_ok=True)
+    os.makedirs(os.path.join(bench_dir, 'renode_portable'), exist_ok=True)
+    link(os.path.join(repo_dir, 'templates'), os.path.join(bench_dir, 'templates'))
+    link(os.path.join(repo_dir, 'configs'), os.path.join(bench_dir, 'configs'))
+    link(os.path.join(scripts_dir, 'standins', 'west'), os.path.join(bench_dir, 'bin', 'west'))
+    link(os.path.join(scripts_dir, 'standins', 'renode'), os.path.join(bench_dir, 'renode_portable', 'renode'))
+    link(os.path.join(scripts_dir, 'standins', 'renode-test'), os.path.join(bench_dir, 'renode_portable', 'renode-test'))
+    generate_zephyr_tree()
+
+def get_process_tree_memory(root_pid):
+    # RSS of the process and all its descendants, and of the biggest one
+    children = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # the name in parentheses may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(pid))
+
+    total = biggest = 0
+    pids = [root_pid]
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    while len(pids) > 0:
+        pid = pids.pop()
+        pids += children.get(pid, [])
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                rss = int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        total += rss
+        biggest = max(biggest, rss)
+    return total, biggest
+
+def run_stage(name, script, env, run):
+    log_filename = os.path.join(bench_dir, f'{name}-{run}.log')
+    print(f"Running {bold(name)}, log in {log_filename}")
+    peak = {'total': 0, 'biggest': 0}
+    start = time.monotonic()
+    with open(log_filename, 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(scripts_dir, script)], cwd=bench_dir, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        done = threading.Event()
+
+        def watch_memory():
+            while not done.wait(memory_interval):
+                total, biggest = get_process_tree_memory(process.pid)
+                peak['total'] = max(peak['total'], total)
+                peak['biggest'] = max(peak['biggest'], biggest)
+        watcher = threading.Thread(target=watch_memory)
+        watcher.start()
+        process.wait()
+        done.set()
+        watcher.join()
+    makespan = time.monotonic() - start
+    if process.returncode != 0:
+        print(red(f"{name} exited with {process.returncode}, see {log_filename}"))
+    return {
+        'stage': name,
+        'returncode': process.returncode,
+        'makespan': round(makespan, 2),
+        'peak_memory': peak['total'],
+        'peak_process_memory': peak['biggest'],
+    }
+
+def load_artifact(filename, default):
+    try:
+        with open(os.path.join(bench_dir, 'artifacts', filename)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+def count_built_boards(sample_names):
+    counts = {'boards': 0, 'built': 0}
+    for sample_name in sample_names:
+        boards = load_artifact(f'built_boards-{sample_name}.json', None)
+        if boards is None:
+            boards = load_artifact('built_boards.json', [])
+        counts['boards'] += sum('build_status' in board for board in boards)
+        counts['built'] += sum(board.get('build_status') == 'BUILT' for board in boards)
+    return counts
+
+def count_simulated_boards(sample_name):
+    results = load_artifact(f'results/results-{sample_name}_all.json', [])
+    return {
+        'boards': sum(result['status'] != 'NOT BUILT' for result in results),
+        'passed': sum(result['status'] == 'PASSED' for result in results),
+    }
+
+def run_benchmark(run, env, sample_names):
+    artifacts_dir = os.path.join(bench_dir, 'artifacts')
+    previous_dir = os.path.join(bench_dir, 'previous_artifacts')
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if run > 0 and 'PREVIOUS_ARTIFACTS' not in os.environ:
+        shutil.move(artifacts_dir, previous_dir)
+        env = dict(env, PREVIOUS_ARTIFACTS=previous_dir)
+    shutil.rmtree(artifacts_dir, ignore_errors=True)
+    os.makedirs(os.path.join(artifacts_dir, 'results'))
+
+    stages = []
+    if mode == 'pipeline':
+        # the pipeline runs one sample at a time
+        for sample_name in sample_names:
+            stage = run_stage(f'pipeline-{sample_name}', 'pipeline.py', dict(env, SAMPLE_NAME=sample_name), run)
+            stage.update(count_simulated_boards(sample_name))
+            stages.append(stage)
+    else:
+        stage = run_stage('build', 'build.py', env, run)
+        stage.update(count_built_boards(sample_names))
+        stages.append(stage)
+        for sample_name in sample_names:
+            stage = run_stage(f'simulate-{sample_name}', 'simulate.py', dict(env, SAMPLE_NAME=sample_name), run)
+            stage.update(count_simulated_boards(sample_name))
+            stages.append(stage)
+    for stage in stages:
+        stage['throughput'] = round(60 * stage['boards'] / stage['makespan'], 1) if stage['makespan'] > 0 else 0
+    return stages
+
+def print_stages(run, stages):
+    print(bold(f"Run {run + 1} of {run_count}"))
+    print(f"{'stage':<28} {'boards':>7} {'ok':>7} {'makespan':>10} {'boards/min':>11} {'peak memory':>12} {'biggest process':>16}")
+    for stage in stages:
+        ok = stage.get('built', stage.get('passed', 0))
+        line = (f"{stage['stage']:<28} {stage['boards']:>7} {ok:>7} {stage['makespan']:>9.1f}s {stage['throughput']:>11.1f} "
+                f"{stage['peak_memory'] / 1024 ** 2:>9.0f} MB {stage['peak_process_memory'] / 1024 ** 2:>13.0f} MB")
+        print(green(line) if stage['returncode'] == 0 else red(line))
+    total = sum(stage['makespan'] for stage in stages)
+    print(f"Total makespan: {bold(f'{total:.1f}s')}")
+
+if __name__ == '__main__':
+    if mode not in ('separate', 'pipeline'):
+        print(f"Unknown BENCH_MODE {mode}, use 'separate' or 'pipeline'")
+        sys.exit(1)
+    profile = latency.load_profile()
+    prepare_bench_dir()
+
+    env = dict(os.environ, BENCH_SEED=seed, PYTHONUNBUFFERED='1')
+    env['PATH'] = os.path.join(bench_dir, 'bin') + os.pathsep + env['PATH']
+    if os.getenv('BENCH_PROFILE'):
+        env['BENCH_PROFILE'] = os.path.realpath(os.getenv('BENCH_PROFILE'))
+    sample_names = os.getenv('SAMPLE_NAME', 'hello_world').split(',')
+    print(f"Benchmarking {bold(mode)} stages on {board_count} boards, seed {seed}, samples {', '.join(sample_names)}")
+
+    runs = []
+    for run in range(run_count):
+        stages = run_benchmark(run, env, sample_names)
+        print_stages(run, stages)
+        runs.append(stages)
+
+    report = {
+        'boards': board_count,
+        'seed': seed,
+        'mode': mode,
+        'profile': profile,
+        'settings': {knob: os.environ[knob] for knob in knobs if knob in os.environ},
+        'runs': runs,
+    }
+    with open(os.path.join(bench_dir, 'benchmark.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved to {os.path.join(bench_dir, 'benchmark.json')}")
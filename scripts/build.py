@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
+import cache
+import checkpoint
+import collections
 import git
+import glob
+import history
 import jinja2
 import json
 import math
+import multiprocessing
 import os
 import re
+import resource
+import sampler
 import shutil
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import tracing
+import transfer
 import yaml
+from dts2repl import dts2repl
 from joblib import Parallel, delayed, parallel_backend
 
 from colorama import init
@@ -28,6 +42,57 @@ def green(text):
     return Fore.GREEN + (text or '') + Style.RESET_ALL
 
 zephyr_path = 'zephyrproject/zephyr'
+# board metadata indexes, one per Zephyr commit
+board_index_dir = os.getenv('BOARD_INDEX', 'board_index')
+# board to shard assignment made in the prepare job, see get_boards_in_shard
+shards_filename = f'{board_index_dir}/shards.json'
+board_index = {}
+Board = collections.namedtuple('Board', ['name', 'arch', 'dir'])
+# keep build directories and a ccache directory there between builds if set
+build_cache = os.path.realpath(os.getenv('BUILD_CACHE')) if os.getenv('BUILD_CACHE') else None
+build_cache_size = int(os.getenv('BUILD_CACHE_SIZE', 20480)) * 1024 * 1024
+# artifacts of an earlier build, used to skip boards unaffected by the changes since then
+previous_artifacts = os.getenv('PREVIOUS_ARTIFACTS')
+# history of every sample being built, by sample name
+build_histories = {}
+# the boards are split between SHARD_COUNT jobs, this one builds shard SHARD_INDEX
+shard_index = int(os.getenv('SHARD_INDEX', 0))
+shard_count = int(os.getenv('SHARD_COUNT', 1))
+# 'inline' runs west spdx right after each build, 'deferred' in a separate
+# low-priority pool and 'off' skips SBOM generation altogether
+spdx_mode = os.getenv('SPDX', 'inline')
+spdx_files = ["spdx/app.spdx", "spdx/build.spdx", "spdx/zephyr.spdx"]
+spdx_queue = None
+# number of lines of west output kept in memory
+west_tail_lines = 200
+# wall-clock time a board may take to build (0 for no limit), after which the
+# whole west process group is killed, and optional per-process limits in MB and seconds
+build_timeout = int(os.getenv('BUILD_TIMEOUT', 1800))
+build_memory_limit = int(os.getenv('BUILD_MEMORY_LIMIT')) if os.getenv('BUILD_MEMORY_LIMIT') else None
+build_cpu_limit = int(os.getenv('BUILD_CPU_LIMIT')) if os.getenv('BUILD_CPU_LIMIT') else None
+build_deadline = None
+# with BUILD_SCHEDULER=1 builds are started only while the node has CPU and
+# memory for them; every build then runs ninja_jobs jobs, needs ninja_jobs /
+# BUILD_CPU_OVERCOMMIT idle CPUs to start and is expected to need ninja_jobs
+# times the peak memory of a single compiler process seen in the previous runs
+build_scheduler = os.getenv('BUILD_SCHEDULER', '0') == '1'
+cpu_count = os.cpu_count() or 1
+ninja_jobs = int(os.getenv('NINJA_JOBS', max(1, cpu_count // 8)))
+build_cpu_overcommit = float(os.getenv('BUILD_CPU_OVERCOMMIT', 1.5))
+build_memory_default = int(os.getenv('BUILD_MEMORY_DEFAULT', 512))
+build_slots = None
+running_builds = None
+reserved_memory = None
+memory_budget = None
+# time, total and idle CPU time of the last /proc/stat reading and the idle
+# CPUs seen since the one before, less the builds started since then
+cpu_sample = None
+cpu_sample_interval = 1
+build_max_rss = 0
+# results of the simulability check, shared by all samples built from one Zephyr commit
+prefilter_cache = cache.open_store(os.getenv('PREFILTER_CACHE'))
+# content-addressed store the artifacts are hardlinked from
+artifact_store = cache.BlobStore(os.getenv('ARTIFACT_STORE'), int(os.getenv('ARTIFACT_STORE_SIZE', 20480)) * 1024 * 1024) if os.getenv('ARTIFACT_STORE') else None
 
 
 def get_board_path(board):
@@ -44,56 +109,425 @@ def find_flash_size(dts_filename):
         dts = f.read()
 
     flash_name = re.search(r"zephyr,flash = &(\w+);", dts).group(1)
-    flash_size = re.search(r"{}:(.*\n)*?.*reg = <(.*)>;".format(flash_name), dts).group(2)
+    # first reg property after the flash node label
+    flash_size = re.compile(r"reg = <(.*)>;").search(dts, dts.index(f"{flash_name}:")).group(1)
     flash_size = flash_size.split()
 
     return flash_name, flash_size
 
+def get_build_path(zephyr_platform, sample_name):
+    if build_cache is None:
+        return f"build.{zephyr_platform}.{sample_name}"
+    return f"{build_cache}/build/{zephyr_platform}.{sample_name}"
+
+def get_ccache_stats(stats_log):
+    # count per-compilation results logged by ccache through CCACHE_STATSLOG
+    hits = misses = 0
+    if os.path.exists(stats_log):
+        with open(stats_log) as f:
+            for line in f:
+                line = line.strip()
+                if line.endswith('cache_hit'):
+                    hits += 1
+                elif line == 'cache_miss':
+                    misses += 1
+    return hits, misses
+
+def place_artifact(src, dest):
+    # copy a file into artifacts/ and return its manifest entry
+    if artifact_store is not None:
+        digest = artifact_store.link(src, dest)
+    else:
+        shutil.copyfile(src, dest)
+        digest = cache.hash_file(dest)
+    return {'hash': digest, 'size': os.path.getsize(dest)}
+
+def update_manifest(zephyr_sample_name, entries):
+    # hashes and sizes of the files placed in the board directory, for the later stages
+    manifest_filename = f"artifacts/{zephyr_sample_name}/{zephyr_sample_name}-manifest.json"
+    manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+    manifest.update(entries)
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f)
+
 def build_and_copy_bin(zephyr_platform, sample_path, args, sample_name, env):
     zephyr_sample_name = f"{zephyr_platform}-{sample_name}"
     return_code = 1
     os.makedirs(f"artifacts/{zephyr_sample_name}", exist_ok=True)
     previous_dir = os.getcwd()
     os.chdir(zephyr_path)
-    build_path = f"build.{zephyr_platform}.{sample_name}"
-    if os.path.isdir(build_path):
-        shutil.rmtree(build_path)
+    build_path = get_build_path(zephyr_platform, sample_name)
+    stats = {}
+    if build_cache is None:
+        if os.path.isdir(build_path):
+            shutil.rmtree(build_path)
+        env = env.copy()
+        env['CCACHE_DISABLE'] = '1'
+        pristine = '--pristine'
+    else:
+        # keep the build directory and let ccache share objects between boards and samples
+        stats['incremental'] = os.path.isdir(os.path.join(build_path, 'zephyr'))
+        stats_log = f"{build_path}.ccache.log"
+        if os.path.exists(stats_log):
+            os.remove(stats_log)
+        env = env.copy()
+        env['CCACHE_DIR'] = f"{build_cache}/ccache"
+        env['CCACHE_STATSLOG'] = stats_log
+        pristine = '--pristine auto'
     log_path = f"../../artifacts/{zephyr_sample_name}/{zephyr_sample_name}-zephyr.log"
 
-    run_west_cmd(f"west spdx --init -d {build_path}", env, log_path)
-    west_output = run_west_cmd(f"west build --pristine -b {zephyr_platform} -d {build_path} {sample_path} {args}".strip(), env, log_path)
-    run_west_cmd(f"west spdx -d {build_path}", env, log_path)
+    if spdx_mode != 'off':
+        with tracing.span('west spdx --init', board=zephyr_platform, sample=sample_name):
+            run_west_cmd(f"west spdx --init -d {build_path}", env, log_path)
+    build_start = time.monotonic()
+    with tracing.span('west build', board=zephyr_platform, sample=sample_name):
+        west_output = run_west_cmd(f"west build {pristine} -b {zephyr_platform} -d {build_path} {sample_path} {args}".strip(), env, log_path)
+    stats['build_time'] = round(time.monotonic() - build_start, 2)
+    if spdx_mode == 'inline':
+        with tracing.span('west spdx', board=zephyr_platform, sample=sample_name):
+            run_west_cmd(f"west spdx -d {build_path}", env, log_path)
 
     os.chdir(previous_dir)
-    file_list=["zephyr/zephyr.elf", "zephyr/zephyr.dts", "zephyr/.config", "spdx/app.spdx", "spdx/build.spdx", "spdx/zephyr.spdx"]
+    build_path = os.path.join(zephyr_path, build_path)
+    file_list=["zephyr/zephyr.elf", "zephyr/zephyr.dts", "zephyr/.config"]
+    if spdx_mode == 'inline':
+        file_list += spdx_files
 
+    manifest = {}
+    copy_start = tracing.now()
     for file_name in file_list:
-        file_path = f"{zephyr_path}/{build_path}/{file_name}"
+        file_path = f"{build_path}/{file_name}"
         base_name = os.path.basename(file_path)
+        # a kept build directory may still have the files of an earlier build
+        if west_output['status'] in ('TIMEOUT', 'OOM'):
+            break
         if os.path.exists(file_path):
             if re.search("spdx/.+", file_name):
-                shutil.copyfile(file_path, f"artifacts/{zephyr_sample_name}/{zephyr_sample_name}-{base_name}")
+                artifact_name = f"{zephyr_sample_name}-{base_name}"
             if file_name == file_list[0]:
-                shutil.copyfile(file_path, f"artifacts/{zephyr_sample_name}/{zephyr_platform}-zephyr-{sample_name}.elf")
+                artifact_name = f"{zephyr_platform}-zephyr-{sample_name}.elf"
                 return_code = 0
             if file_name == file_list[1]:
-                shutil.copyfile(file_path, f"artifacts/{zephyr_sample_name}/{zephyr_sample_name}.dts")
+                artifact_name = f"{zephyr_sample_name}.dts"
             if file_name == file_list[2]:
-                shutil.copyfile(file_path, f"artifacts/{zephyr_sample_name}/{zephyr_sample_name}-config")
-    if os.path.isdir(f"{zephyr_path}/{build_path}"):
-        shutil.rmtree(f"{zephyr_path}/{build_path}")
-    return return_code, west_output
+                artifact_name = f"{zephyr_sample_name}-config"
+            manifest[artifact_name] = place_artifact(file_path, f"artifacts/{zephyr_sample_name}/{artifact_name}")
+    update_manifest(zephyr_sample_name, manifest)
+    tracing.add_span('copy artifacts', copy_start, tracing.now(), board=zephyr_platform, sample=sample_name)
+    if build_cache is None:
+        # a deferred SBOM is generated from the build directory, so it has to stay until then
+        if os.path.isdir(build_path) and spdx_mode != 'deferred':
+            shutil.rmtree(build_path)
+    else:
+        stats['ccache_hits'], stats['ccache_misses'] = get_ccache_stats(stats_log)
+        update_build_time(build_path, stats)
+    return return_code, west_output, stats
 
-def run_west_cmd(cmd, env, log_file):
+def generate_spdx(zephyr_platform, sample_name, env):
+    zephyr_sample_name = f"{zephyr_platform}-{sample_name}"
+    previous_dir = os.getcwd()
+    os.chdir(zephyr_path)
+    build_path = get_build_path(zephyr_platform, sample_name)
+    log_path = f"../../artifacts/{zephyr_sample_name}/{zephyr_sample_name}-zephyr.log"
+    start_build_watchdog()
+    with tracing.span('west spdx', board=zephyr_platform, sample=sample_name):
+        run_west_cmd(f"west spdx -d {build_path}", env, log_path)
+    os.chdir(previous_dir)
+
+    build_path = os.path.join(zephyr_path, build_path)
+    manifest = {}
+    for file_name in spdx_files:
+        file_path = f"{build_path}/{file_name}"
+        if os.path.exists(file_path):
+            artifact_name = f"{zephyr_sample_name}-{os.path.basename(file_path)}"
+            manifest[artifact_name] = place_artifact(file_path, f"artifacts/{zephyr_sample_name}/{artifact_name}")
+    update_manifest(zephyr_sample_name, manifest)
+    if build_cache is None and os.path.isdir(build_path):
+        shutil.rmtree(build_path)
+
+def spdx_worker(queue):
+    # SBOMs are not needed by the build itself, so don't let them compete with the compilers
+    os.nice(10)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        generate_spdx(*item)
+
+def start_spdx_workers(spdx_jobs):
+    global spdx_queue
+    spdx_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=spdx_worker, args=(spdx_queue,)) for _ in range(spdx_jobs)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def stop_spdx_workers(workers):
+    for _ in workers:
+        spdx_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+def update_build_time(build_path, stats):
+    # remember how long a cold build took to estimate the time saved by the cache
+    time_path = f"{build_path}.time"
+    if os.path.isdir(build_path):
+        os.utime(build_path)
+    if not stats['incremental'] and stats['ccache_hits'] == 0:
+        with open(time_path, 'w') as f:
+            f.write(str(stats['build_time']))
+    if os.path.exists(time_path):
+        with open(time_path) as f:
+            stats['time_saved'] = round(max(float(f.read()) - stats['build_time'], 0), 2)
+
+def print_build_cache_stats(build_stats):
+    hits = sum(stats.get('ccache_hits', 0) for stats in build_stats)
+    misses = sum(stats.get('ccache_misses', 0) for stats in build_stats)
+    time_saved = sum(stats.get('time_saved', 0) for stats in build_stats)
+    hit_rate = 100 * hits / (hits + misses) if hits + misses > 0 else 0
+    print(f"Build cache: {bold(f'{hit_rate:.1f}%')} ccache hit rate, {bold(f'{time_saved:.0f}s')} saved")
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files if not os.path.islink(os.path.join(root, f)))
+
+def evict_build_cache():
+    # drop the least recently used build directories until the cache fits in its budget
+    build_dirs = f"{build_cache}/build"
+    if not os.path.isdir(build_dirs):
+        return
+    dirs = []
+    for d in os.listdir(build_dirs):
+        d = os.path.join(build_dirs, d)
+        if os.path.isdir(d):
+            dirs.append((os.path.getmtime(d), get_dir_size(d), d))
+    total_size = sum(size for _, size, _ in dirs)
+    for _, size, d in sorted(dirs):
+        if total_size <= build_cache_size:
+            break
+        print(f"Evicting {bold(os.path.basename(d))} from the build cache")
+        shutil.rmtree(d, ignore_errors=True)
+        for suffix in ('.time', '.ccache.log'):
+            if os.path.exists(d + suffix):
+                os.remove(d + suffix)
+        total_size -= size
+
+def scan_west_output(line, output):
+    m = re.search(r"region `FLASH' overflowed by (\d+) bytes", line)
+    if m is not None:
+        output['flash_overflow'] = int(m.group(1))
+    m = re.search(r"(?P<region>\w+){1}:\s*(?P<used>\d+\s+\w{1,2})\s*(?P<size>\d+\s+\w{1,2})\s*(?P<percentage>\d+.\d+%)", line)
+    if m is not None:
+        output['memory'][m.group('region')] = {
+            'used': conv_zephyr_mem_usage(m.group('used')),
+            'size': conv_zephyr_mem_usage(m.group('size')),
+        }
+    if re.search(r"virtual memory exhausted|out of memory allocating|Cannot allocate memory|std::bad_alloc|Killed signal terminated program", line):
+        output['out_of_memory'] = True
+    # errors the flash size overlay may cause: the devicetree doesn't accept
+    # it or the memory regions derived from it don't fit the image
+    if re.search(r"devicetree error|Label or path \S+ not found|will not fit in region|region `\w+' overflowed", line):
+        output['overlay_error'] = True
+
+def get_oom_kills():
+    # number of processes the OOM killer has killed so far, in the cgroup of
+    # the job if it tells, None if the kernel doesn't say
+    for filename in ('/sys/fs/cgroup/memory.events', '/proc/vmstat'):
+        try:
+            with open(filename) as f:
+                for line in f:
+                    key, value = line.split()
+                    if key == 'oom_kill':
+                        return int(value)
+        except (FileNotFoundError, ValueError):
+            pass
+    return None
+
+def start_build_watchdog():
+    global build_deadline, build_max_rss
+    build_deadline = time.monotonic() + build_timeout if build_timeout > 0 else None
+    build_max_rss = 0
+
+def get_available_memory():
+    with open('/proc/meminfo') as f:
+        meminfo = dict(line.split(':', 1) for line in f)
+    available = int(meminfo['MemAvailable'].split()[0]) * 1024
+    # in a container the cgroup limit is usually lower than what the host has
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        with open('/sys/fs/cgroup/memory.current') as f:
+            usage = int(f.read())
+        if limit != 'max':
+            available = min(available, int(limit) - usage)
+    except (FileNotFoundError, ValueError):
+        pass
+    return available
+
+def start_build_scheduler():
+    # shared by the build workers, which inherit them when they are forked
+    global build_slots, running_builds, reserved_memory, memory_budget, cpu_sample
+    build_slots = multiprocessing.Condition()
+    running_builds = multiprocessing.Value('i', 0, lock=False)
+    reserved_memory = multiprocessing.Value('d', 0, lock=False)
+    memory_budget = get_available_memory() * 0.9
+    cpu_sample = multiprocessing.Array('d', [time.monotonic(), *read_cpu_times(), cpu_count], lock=False)
+    print(f"Build scheduler: {cpu_count} CPUs, {ninja_jobs} ninja jobs per build, {memory_budget / 1024 ** 3:.1f} GB for the builds")
+
+def get_expected_memory(board_name, sample_name):
+    build_history = build_histories[sample_name]
+    rss = build_history.get(board_name, {}).get('build_rss')
+    if rss is None:
+        # the heaviest board of the sample, since the boards of a sample are alike
+        known_rss = [entry['build_rss'] for entry in build_history.values() if 'build_rss' in entry]
+        rss = max(known_rss) if len(known_rss) > 0 else build_memory_default
+    return rss * 1024 * 1024 * ninja_jobs
+
+def read_cpu_times():
+    # total and idle time of all CPUs so far, from the first line of /proc/stat
+    with open('/proc/stat') as f:
+        times = [int(value) for value in f.readline().split()[1:]]
+    # idle and iowait
+    return sum(times), times[3] + times[4]
+
+def get_idle_cpus():
+    # CPUs idle over the last interval; unlike the load average it follows the
+    # load within cpu_sample_interval, builds started since the last reading
+    # are counted as busy until the next one shows them
+    now = time.monotonic()
+    if now - cpu_sample[0] >= cpu_sample_interval:
+        total, idle = read_cpu_times()
+        if total > cpu_sample[1]:
+            cpu_sample[3] = cpu_count * (idle - cpu_sample[2]) / (total - cpu_sample[1])
+        cpu_sample[0], cpu_sample[1], cpu_sample[2] = now, total, idle
+    return cpu_sample[3]
+
+def can_start_build(expected_memory):
+    # the number of builds is capped, as a starting build is slow to show its
+    # load, and otherwise follows the live CPU load
+    if (running_builds.value + 1) * ninja_jobs > cpu_count * build_cpu_overcommit:
+        return False
+    if get_idle_cpus() * build_cpu_overcommit < ninja_jobs:
+        return False
+    return reserved_memory.value + expected_memory <= memory_budget and get_available_memory() >= expected_memory
+
+def acquire_build_slot(expected_memory):
+    if build_slots is None:
+        return
+    with build_slots:
+        # one build is always let through, so that a big one can't stall the
+        # pool; the others are woken up whenever a build finishes
+        while running_builds.value > 0 and not can_start_build(expected_memory):
+            build_slots.wait()
+        running_builds.value += 1
+        reserved_memory.value += expected_memory
+        cpu_sample[3] -= ninja_jobs
+
+def release_build_slot(expected_memory):
+    if build_slots is None:
+        return
+    with build_slots:
+        running_builds.value -= 1
+        reserved_memory.value -= expected_memory
+        build_slots.notify_all()
+
+def set_build_limits():
+    # runs in the child before exec, so the limits apply to every process of the build
+    if build_memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (build_memory_limit * 1024 * 1024,) * 2)
+    if build_cpu_limit is not None:
+        # SIGXCPU at the soft limit
+        resource.setrlimit(resource.RLIMIT_CPU, (build_cpu_limit, build_cpu_limit + 5))
+
+def kill_process_group(process, killed):
+    killed.set()
     try:
-        output = subprocess.check_output((cmd.split(" ")), env=env, stderr=subprocess.STDOUT).decode()
-    except subprocess.CalledProcessError as error:
-        output = error.output.decode()
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_west_cmd(cmd, env, log_file):
+    # write the output to the log as it comes and keep only its tail and the facts we need
+    output = {'flash_overflow': None, 'memory': {}, 'out_of_memory': False, 'overlay_error': False}
+    tail = collections.deque(maxlen=west_tail_lines)
+    timeout = build_deadline - time.monotonic() if build_deadline is not None else None
+    if timeout is not None and timeout <= 0:
+        output['status'] = 'TIMEOUT'
+        output['tail'] = ''
+        return output
+
+    killed = threading.Event()
+    oom_kills = get_oom_kills()
     with open(log_file, 'a') as file:
-        file.write(output)
+        process = subprocess.Popen(cmd.split(" "), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   start_new_session=True, preexec_fn=set_build_limits)
+        # the watchdog kills west together with CMake, ninja and the compilers
+        watchdog = None
+        if timeout is not None:
+            watchdog = threading.Timer(timeout, kill_process_group, (process, killed))
+            watchdog.start()
+        for line in process.stdout:
+            line = line.decode(errors='replace')
+            file.write(line)
+            tail.append(line)
+            scan_west_output(line, output)
+        # wait4 also tells the peak memory of the biggest process of the build
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+        if watchdog is not None:
+            watchdog.cancel()
+        if killed.is_set():
+            file.write(f"\nKilled after exceeding the build timeout of {build_timeout}s\n")
+
+    if killed.is_set() or process.returncode == -signal.SIGXCPU:
+        output['status'] = 'TIMEOUT'
+    elif output['out_of_memory'] or (process.returncode == -signal.SIGKILL and oom_kills is not None and get_oom_kills() > oom_kills):
+        # either hit the memory limit or got killed by the OOM killer, a
+        # SIGKILL from anyone else is an ordinary failure
+        output['status'] = 'OOM'
+    elif process.returncode != 0:
+        output['status'] = 'FAILED'
+    else:
+        output['status'] = 'OK'
+    output['tail'] = ''.join(tail)
+    global build_max_rss
+    build_max_rss = max(build_max_rss, rusage.ru_maxrss // 1024)
     return output
 
-def build_sample(zephyr_platform, sample_name, sample_path, sample_args, toolchain):
+def conv_zephyr_mem_usage(val):
+    if val.endswith(' B'):
+        val = int(val[:-2])
+    elif val.endswith(' KB'):
+        val = int(val[:-2]) * 1024
+    elif val.endswith(' MB'):
+        val = int(val[:-2]) * 1024 * 1024
+    elif val.endswith(' GB'):
+        val = int(val[:-2]) * 1024 * 1024 * 1024
+
+    return val
+
+def build_with_flash_size(zephyr_platform, sample_path, sample_args, sample_name, env, flash):
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8') as f:
+        f.write(dts_flash_template.render(
+            flash_name=flash['flash_name'],
+            reg_base=flash['flash_base'],
+            reg_size=flash['flash_size'] + flash['flash_overflow']
+        ))
+        f.flush()
+        overlay_path = f.name
+
+        overlay_args = f'-DDTC_OVERLAY_FILE={overlay_path}'
+        args = f'-- {sample_args} {overlay_args}'
+        return build_and_copy_bin(zephyr_platform, sample_path, args, sample_name, env)
+
+def merge_build_stats(stats, retry_stats):
+    for key in ('build_time', 'ccache_hits', 'ccache_misses', 'time_saved'):
+        if key in retry_stats:
+            stats[key] = stats.get(key, 0) + retry_stats[key]
+
+def build_sample(zephyr_platform, sample_name, sample_path, sample_args, toolchain, flash_prediction=None):
     env = os.environ.copy()
     if toolchain == "zephyr":
         pass
@@ -105,46 +539,82 @@ def build_sample(zephyr_platform, sample_name, sample_path, sample_args, toolcha
     else:
         print(f"Toolchain {bold(toolchain)} not found!")
     print(f"Building for {bold(zephyr_platform)}, sample: {bold(sample_name)} with args: {bold(sample_args)} using {bold(toolchain)} toolchain.")
+    if build_scheduler:
+        env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(ninja_jobs)
+    if build_cache is not None:
+        # a kept build directory must not reuse the overlay of an earlier flash size retry
+        sample_args = f'{sample_args} -DDTC_OVERLAY_FILE='.strip()
     args = f'-- {sample_args}' if sample_args != '' else ''
-    return_code, west_output = build_and_copy_bin(zephyr_platform, sample_path, args, sample_name, env)
-    # try increasing flash size if the sample doesn't fit in it
     dts_filename = 'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}.dts'.format(board_name=zephyr_platform, sample_name=sample_name)
-    m = re.search(r"region `FLASH' overflowed by (\d+) bytes", west_output)
+    flash = None
+
+    if flash_prediction is not None:
+        # the sample did not fit in the flash last time, so build with a bigger one right away
+        print(f"Increasing flash size of {bold(zephyr_platform)} by {flash_prediction['flash_overflow']} bytes as in the previous run.")
+        flash = dict(flash_prediction)
+        return_code, west_output, stats = build_with_flash_size(zephyr_platform, sample_path, sample_args, sample_name, env, flash)
+        if return_code and west_output['flash_overflow'] is None and west_output.get('overlay_error'):
+            # the overlay no longer applies to this board, fall back to a regular build
+            print(f"Build with predicted flash size failed for {bold(zephyr_platform)}, building without it.")
+            flash = None
+
+    if flash is None:
+        return_code, west_output, stats = build_and_copy_bin(zephyr_platform, sample_path, args, sample_name, env)
+
+    # try increasing flash size if the sample doesn't fit in it
     if return_code:
-        if m is not None and os.path.exists(dts_filename):
-            shutil.copy2(dts_filename, dts_filename + '.orig')
-            flash_increase = math.ceil(int(m.group(1)) / 1024) * 1024
+        if west_output['flash_overflow'] is not None and os.path.exists(dts_filename):
+            if flash is None:
+                update_manifest(f"{zephyr_platform}-{sample_name}", {
+                    os.path.basename(dts_filename) + '.orig': place_artifact(dts_filename, dts_filename + '.orig'),
+                })
+            flash_increase = math.ceil(west_output['flash_overflow'] / 1024) * 1024
             flash_name, flash_size = find_flash_size(dts_filename)
             if len(flash_size) >= 2:
                 flash_base, flash_size = flash_size[-2:]
                 flash_size = int(flash_size, 16)
-                flash_size += flash_increase
+                if flash is None:
+                    flash = {
+                        'flash_name': flash_name,
+                        'flash_base': flash_base,
+                        'flash_size': flash_size,
+                    }
+                # the overflow is always counted from the original flash size
+                flash['flash_overflow'] = flash_size + flash_increase - flash['flash_size']
 
-                with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8') as f:
-                    f.write(dts_flash_template.render(
-                        flash_name=flash_name,
-                        reg_base=flash_base,
-                        reg_size=flash_size
-                    ))
-                    f.flush()
-                    overlay_path = f.name
+                # build again, this time with bigger flash size
+                with tracing.span('flash retry', board=zephyr_platform, sample=sample_name):
+                    return_code, west_output, retry_stats = build_with_flash_size(zephyr_platform, sample_path, sample_args, sample_name, env, flash)
+                merge_build_stats(stats, retry_stats)
+    elif flash is not None:
+        # check whether the sample still needs the bigger flash
+        if 'FLASH' in west_output['memory'] and west_output['memory']['FLASH']['used'] <= flash['flash_size']:
+            flash['flash_overflow'] = 0
 
-                    # build again, this time with bigger flash size
-                    overlay_args = f'-DDTC_OVERLAY_FILE={overlay_path}'
-                    args = f'-- {sample_args} {overlay_args}'
-                    build_and_copy_bin(zephyr_platform, sample_path, args, sample_name, env)
+    # facts about the build for the simulation stage, so that it doesn't have to parse the log
+    build_facts = {'memory': west_output['memory']}
+    if flash is not None:
+        build_facts['flash'] = flash
+    with open(f"artifacts/{zephyr_platform}-{sample_name}/{zephyr_platform}-{sample_name}-build.json", "w") as f:
+        json.dump(build_facts, f)
 
-def get_board_yaml_path(board_name, board_path):
-    board_yaml = f'{zephyr_path}/{board_path}/{board_name}.yaml'
+    if spdx_mode == 'deferred':
+        spdx_queue.put((zephyr_platform, sample_name, env))
 
-    # this hack is needed for pinetime_devkit0
-    if not os.path.exists(board_yaml):
-        board_yaml = f'{zephyr_path}/{board_path}/{board_name.replace("_", "-")}.yaml'
+    if return_code == 0:
+        status = 'BUILT'
+    elif west_output['status'] in ('TIMEOUT', 'OOM'):
+        status = west_output['status']
+        print(red(f"Build for {zephyr_platform} stopped: {status}"))
+    else:
+        status = 'FAILED'
 
-    return board_yaml
+    info = {'flash': flash, 'status': status, 'build_rss': build_max_rss}
+    if build_cache is not None:
+        info['build_cache'] = stats
+    return info
 
 def try_build(board_name, board_path, sample_name, sample_path):
-    board_yaml = get_board_yaml_path(board_name, board_path)
     config_path = f'configs/{sample_name}.conf'
     if os.path.exists(config_path):
         sample_args = f'-DCONF_FILE={os.path.realpath(config_path)}'
@@ -152,7 +622,18 @@ def try_build(board_name, board_path, sample_name, sample_path):
         sample_args = ''
 
     # build the sample
-    build_sample(board_name, sample_name, f'samples/{sample_path}', sample_args, get_toolchain(board_yaml))
+    expected_memory = get_expected_memory(board_name, sample_name)
+    with tracing.span('wait for build slot', board=board_name, sample=sample_name):
+        acquire_build_slot(expected_memory)
+    try:
+        start_build_watchdog()
+        start = time.monotonic()
+        flash_prediction = build_histories[sample_name].get(board_name, {}).get('flash')
+        info = build_sample(board_name, sample_name, f'samples/{sample_path}', sample_args, board_index[board_name]['toolchain'], flash_prediction)
+        info['build_duration'] = round(time.monotonic() - start, 2)
+        return info
+    finally:
+        release_build_slot(expected_memory)
 
 def get_boards():
     # the Zephyr utility has its own argument parsing, so avoid args clash
@@ -172,10 +653,8 @@ def get_boards():
                         present), may be given more than once''')
     return find_arch2boards(parser.parse_args())
 
-def get_full_name(yaml_filename):
-    if os.path.exists(yaml_filename):
-        with open(yaml_filename) as f:
-            board_data = yaml.load(f, Loader=yaml.FullLoader)
+def get_full_name(board_data):
+    if board_data is not None:
         full_board_name = board_data['name']
         if len(full_board_name) > 50:
             full_board_name = re.sub(r'\(.*\)', '', full_board_name)
@@ -183,11 +662,9 @@ def get_full_name(yaml_filename):
         full_board_name = ''
     return full_board_name
 
-def get_toolchain(yaml_filename):
-    if os.path.exists(yaml_filename):
-        with open(yaml_filename) as f:
-            board_data = yaml.load(f, Loader=yaml.FullLoader)
-            toolchains = board_data['toolchain']
+def get_toolchain(board_data, board_name):
+    if board_data is not None:
+        toolchains = board_data['toolchain']
 
         # try using the default zephyr toolchain
         if 'zephyr' in toolchains:
@@ -195,11 +672,87 @@ def get_toolchain(yaml_filename):
         else:
             toolchain = toolchains[0]
     else:
-        print(f'Could not open YAML file {yaml_filename}! Defaulting to Zephyr toolchain...')
+        print(f'Could not find YAML file for {board_name}! Defaulting to Zephyr toolchain...')
         toolchain = 'zephyr'
 
     return toolchain
 
+def read_board_yaml(board_name, board_path, yaml_cache):
+    # find the YAML file describing the board by its identifier, e.g. pinetime_devkit0
+    # is described by pinetime-devkit0.yaml
+    for yaml_filename in sorted(glob.glob(f'{zephyr_path}/{board_path}/*.yaml')):
+        if yaml_filename not in yaml_cache:
+            try:
+                with open(yaml_filename) as f:
+                    yaml_cache[yaml_filename] = yaml.load(f, Loader=yaml.FullLoader)
+            except yaml.YAMLError:
+                yaml_cache[yaml_filename] = None
+        board_data = yaml_cache[yaml_filename]
+        if isinstance(board_data, dict) and board_data.get('identifier') == board_name:
+            return yaml_filename, board_data
+    return None, None
+
+def get_board_entry(board, yaml_cache):
+    board_path = get_board_path(board)
+    yaml_filename, board_data = read_board_yaml(board.name, board_path, yaml_cache)
+    dts_filename = f'{board_path}/{board.name}.dts'
+    return {
+        "name": board.name,
+        "arch": board.arch,
+        "path": board_path,
+        "yaml": os.path.relpath(yaml_filename, zephyr_path) if yaml_filename is not None else None,
+        "dts": dts_filename if os.path.exists(f'{zephyr_path}/{dts_filename}') else None,
+        "toolchain": get_toolchain(board_data, board.name),
+        "full_name": get_full_name(board_data),
+    }
+
+def get_board_trees(zephyr_repo, board_paths):
+    # git tree hash of every board directory, None if it has local changes (e.g. from our patches)
+    tree = zephyr_repo.head.commit.tree
+    changed_paths = zephyr_repo.git.diff('--name-only').splitlines() + zephyr_repo.untracked_files
+    trees = {}
+    for board_path in board_paths:
+        if any(path.startswith(board_path + '/') for path in changed_paths):
+            trees[board_path] = None
+            continue
+        try:
+            trees[board_path] = (tree / board_path).hexsha
+        except KeyError:
+            trees[board_path] = None
+    return trees
+
+def load_board_index():
+    # board metadata is collected once per Zephyr commit; entries of the most
+    # recent earlier index are reused for board directories that didn't change
+    zephyr_repo = git.Repo(zephyr_path)
+    index_filename = f'{board_index_dir}/boards-{zephyr_repo.head.commit.hexsha}.json'
+    if os.path.exists(index_filename):
+        with open(index_filename) as f:
+            return json.load(f)
+
+    previous_index = {}
+    previous_indexes = sorted(glob.glob(f'{board_index_dir}/boards-*.json'), key=os.path.getmtime)
+    if len(previous_indexes) > 0:
+        with open(previous_indexes[-1]) as f:
+            previous_index = json.load(f)
+
+    boards = flatten(get_boards()).values()
+    trees = get_board_trees(zephyr_repo, set(get_board_path(board) for board in boards))
+    yaml_cache = {}
+    index = {}
+    for board in boards:
+        tree = trees[get_board_path(board)]
+        entry = previous_index.get(board.name)
+        if entry is None or tree is None or entry.get('tree') != tree or entry['arch'] != board.arch:
+            entry = get_board_entry(board, yaml_cache)
+            entry['tree'] = tree
+        index[board.name] = entry
+
+    os.makedirs(board_index_dir, exist_ok=True)
+    with open(index_filename, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    return index
+
 def flatten(zephyr_boards):
     flat_boards = {}
     for arch in zephyr_boards:
@@ -216,10 +769,11 @@ samples = (
     ("tensorflow_lite_micro", "modules/tflite-micro/hello_world"),
 )
 
-def get_sample_name_path():
-    sample_name = os.getenv('SAMPLE_NAME')
-    idx = list(map(lambda x: x[0], samples)).index(sample_name) if sample_name is not None else 0
-    return samples[idx]
+def get_samples_to_build():
+    # SAMPLE_NAME may list several samples separated by commas, which are then
+    # built in one pool over the same Zephyr tree
+    sample_names = os.getenv('SAMPLE_NAME', samples[0][0]).split(',')
+    return [samples[list(map(lambda x: x[0], samples)).index(sample_name)] for sample_name in sample_names]
 
 def loop_wrapper(b, i, total_boards, sample_name, sample_path):
     board_name = b if isinstance(b, str) else b.name
@@ -229,13 +783,210 @@ def loop_wrapper(b, i, total_boards, sample_name, sample_path):
     remote_board = next(remote_board, None)
     out = None
 
-    try_build(board_name, get_board_path(flat_boards[board_name]), sample_name, sample_path)
+    with sampler.busy('build'):
+        out = try_build(board_name, get_board_path(flat_boards[board_name]), sample_name, sample_path)
+    checkpoint.append(f'built_boards-{sample_name}', {'name': board_name, 'info': out})
     if total_boards > 1:
         print(f"<< [{i} / {total_boards}] -- {board_name} --")
     return out
 
 
-if __name__ == '__main__':
+# files generated by the build stage, which can be reused for an unaffected board
+build_artifacts = ('-zephyr.log', '-build.json', '-manifest.json', '.elf', '.dts', '.dts.orig', '-config', '-app.spdx', '-build.spdx', '-zephyr.spdx')
+
+def is_ignored_path(path, sample_path):
+    if path.startswith(('doc/', 'tests/', '.github/')) or path.endswith(('.rst', '.md')):
+        return True
+    if path in ('MAINTAINERS.yml', 'CODEOWNERS', '.gitignore', '.mailmap'):
+        return True
+    # other samples do not affect the one being built
+    return path.startswith('samples/') and not path.startswith(f'samples/{sample_path}/')
+
+def get_driver_config(path):
+    # find the Kconfig option a driver source is built under
+    cmake_path = os.path.join(zephyr_path, os.path.dirname(path), 'CMakeLists.txt')
+    if not path.endswith('.c') or not os.path.exists(cmake_path):
+        return None
+    with open(cmake_path) as f:
+        for line in f:
+            if os.path.basename(path) in line:
+                m = re.search(r'\((CONFIG_\w+)', line)
+                return m.group(1) if m is not None else None
+    return None
+
+def has_config(board_name, sample_name, config):
+    config_path = f'{previous_artifacts}/{board_name}-{sample_name}/{board_name}-{sample_name}-config'
+    if not os.path.exists(config_path):
+        return True
+    with open(config_path) as f:
+        return f'{config}=y' in f.read().split('\n')
+
+def get_affected_boards(changed_paths, boards, sample_name, sample_path):
+    # returns names of the boards affected by the changed paths or None if
+    # the change may affect any board and everything has to be rebuilt
+    affected = set()
+    for path in changed_paths:
+        parts = path.split('/')
+        config = get_driver_config(path) if parts[0] == 'drivers' else None
+        if is_ignored_path(path, sample_path):
+            continue
+        elif parts[0] == 'boards' and len(parts) > 3 and parts[1] not in ('common', 'shields'):
+            board_dir = '/'.join(parts[:3])
+            affected.update(b.name for b in boards if get_board_path(b) == board_dir)
+        elif parts[0] == 'boards' and len(parts) == 3 and parts[1] not in ('common', 'shields'):
+            affected.update(b.name for b in boards if b.arch == parts[1])
+        elif parts[0] in ('arch', 'soc', 'dts') and len(parts) > 2 and parts[1] not in ('common', 'bindings'):
+            affected.update(b.name for b in boards if b.arch == parts[1])
+        elif config is not None:
+            affected.update(b.name for b in boards if has_config(b.name, sample_name, config))
+        else:
+            print(f"{bold(path)} may affect all boards, rebuilding everything")
+            return None
+    return affected
+
+def get_reusable_boards(boards, sample_name, sample_path):
+    # boards not affected by changes since the base commit can reuse its artifacts
+    if not os.getenv('CHANGE_IMPACT'):
+        return set()
+    base_commit = os.getenv('CHANGE_IMPACT_BASE')
+    if base_commit is None and os.path.exists('last_zephyr_commit'):
+        with open('last_zephyr_commit') as f:
+            base_commit = f.read().strip()
+    if previous_artifacts is None or not os.path.isdir(previous_artifacts) or not base_commit:
+        return set()
+
+    try:
+        zephyr_repo = git.Repo(zephyr_path)
+        changed_paths = zephyr_repo.git.diff('--name-only', base_commit, 'HEAD').splitlines()
+    except git.exc.GitCommandError:
+        print(f"Could not diff against {bold(base_commit)}, rebuilding everything")
+        return set()
+
+    affected = get_affected_boards(changed_paths, boards, sample_name, sample_path)
+    if affected is None:
+        return set()
+
+    reusable = set()
+    for board in boards:
+        if board.name not in affected and os.path.isdir(f'{previous_artifacts}/{board.name}-{sample_name}'):
+            reusable.add(board.name)
+    print(f"{len(changed_paths)} paths changed since {bold(base_commit)}, reusing artifacts of {len(reusable)} / {len(boards)} boards")
+    return reusable
+
+def reuse_artifacts(board_name, sample_name):
+    zephyr_sample_name = f"{board_name}-{sample_name}"
+    os.makedirs(f"artifacts/{zephyr_sample_name}", exist_ok=True)
+    for file_name in os.listdir(f"{previous_artifacts}/{zephyr_sample_name}"):
+        if file_name.endswith(build_artifacts):
+            if artifact_store is not None:
+                artifact_store.link(f"{previous_artifacts}/{zephyr_sample_name}/{file_name}", f"artifacts/{zephyr_sample_name}/{file_name}")
+            else:
+                shutil.copy2(f"{previous_artifacts}/{zephyr_sample_name}/{file_name}", f"artifacts/{zephyr_sample_name}/{file_name}")
+
+def get_cpu_name(arch, dts_filename):
+    # same as in simulate.py: the first CPU in the dependency chain that dts2repl supports
+    for cpu in dts2repl.get_cpu_dep_chain(arch, dts_filename, zephyr_path, []):
+        if cpu[0] != '!':
+            return cpu
+    return ''
+
+def preprocess_dts(board, output):
+    # run the C preprocessor over the board DTS the same way the Zephyr build does
+    board_path = get_board_path(board)
+    dts_filename = f"{zephyr_path}/{board_index[board.name]['dts']}"
+    includes = [f'{zephyr_path}/{board_path}', f'{zephyr_path}/dts/{board.arch}', f'{zephyr_path}/dts',
+                f'{zephyr_path}/dts/common', f'{zephyr_path}/include', f'{zephyr_path}/include/zephyr']
+    cmd = ['cpp', '-nostdinc', '-undef', '-D__DTS__', '-x', 'assembler-with-cpp', '-P', '-E']
+    cmd += [f'-I{path}' for path in includes]
+    cmd += ['-include', dts_filename, '-o', output, '/dev/null']
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except FileNotFoundError:
+        return False
+
+def check_board(board):
+    # returns why the board can't be simulated, or None if it may be
+    if board_index[board.name]['dts'] is None:
+        return None
+    dts_filename = f"{zephyr_path}/{board_index[board.name]['dts']}"
+    try:
+        if get_cpu_name(board.arch, dts_filename) == '':
+            return 'No supported CPU'
+        with tempfile.NamedTemporaryFile(suffix='.dts') as f:
+            # when in doubt, build the board anyway
+            if not preprocess_dts(board, f.name):
+                return None
+            if dts2repl.get_uart(f.name) is None:
+                return 'No uart'
+    except Exception as e:
+        print(f"Could not check {bold(board.name)}: {e}")
+    return None
+
+def get_previous_uart(board_name, sample_name):
+    # whether the DTS generated by a real build of the board has a UART, None
+    # if there is no such DTS; unlike the board DTS it has the sample overlays,
+    # module DTS roots and node deletions applied
+    dts_filename = f'{previous_artifacts}/{board_name}-{sample_name}/{board_name}-{sample_name}.dts'
+    if previous_artifacts is None or not os.path.exists(dts_filename):
+        return None
+    try:
+        return dts2repl.get_uart(dts_filename) is not None
+    except Exception as e:
+        print(f"Could not check the previous DTS of {bold(board_name)}: {e}")
+        return None
+
+def keep_previous_dts(board_name, sample_name):
+    # the board is not built, so the DTS which confirmed it has no UART is
+    # passed on to the next run in its place
+    board_dir = f'artifacts/{board_name}-{sample_name}'
+    os.makedirs(board_dir, exist_ok=True)
+    shutil.copy2(f'{previous_artifacts}/{board_name}-{sample_name}/{board_name}-{sample_name}.dts', board_dir)
+
+def check_boards(boards, thread_number):
+    # the checks only read the board DTS, so they are shared by all samples and
+    # jobs of a Zephyr commit through PREFILTER_CACHE
+    zephyr_commit = git.Repo(zephyr_path).git.rev_parse('HEAD')
+    key = cache.hash_data('prefilter', zephyr_commit)
+    checked = prefilter_cache.get(key) if prefilter_cache is not None else None
+    if checked is None:
+        with parallel_backend('multiprocessing', n_jobs=thread_number):
+            reasons = Parallel()(delayed(check_board)(board) for board in boards)
+        checked = {board.name: reason for board, reason in zip(boards, reasons)}
+        if prefilter_cache is not None:
+            prefilter_cache.put(key, checked)
+    return checked
+
+def get_unsimulable_boards(boards, sample_name, sample_path, thread_number):
+    # boards without a UART or a supported CPU would only be built to fail in simulation
+    if not os.getenv('PREFILTER'):
+        return {}
+
+    checked = check_boards(boards, thread_number)
+    unsimulable = {}
+    unconfirmed = 0
+    for board in boards:
+        # a sample overlay may add what the board is missing
+        if os.path.exists(f'{zephyr_path}/samples/{sample_path}/boards/{board.name}.overlay'):
+            continue
+        if checked.get(board.name) == 'No uart':
+            # the board DTS lacks what the build may add, so the board is only
+            # skipped once the DTS of a real build confirms it has no UART
+            previous_uart = get_previous_uart(board.name, sample_name)
+            if previous_uart is None:
+                unconfirmed += 1
+                continue
+            if previous_uart:
+                print(f"{bold(board.name)} had a UART in the previous build, building it anyway")
+                continue
+            keep_previous_dts(board.name, sample_name)
+        if checked.get(board.name) is not None:
+            unsimulable[board.name] = checked[board.name]
+    if unconfirmed > 0:
+        print(f"Building {unconfirmed} boards without a UART in their board DTS and no previous build to confirm it")
+    print(f"Skipping {len(unsimulable)} / {len(boards)} boards which can't be simulated")
+    return unsimulable
+
+def write_zephyr_version():
     # Get and write Zephyr version; save commit hash for later usage
     with open('artifacts/zephyr.version', 'w') as f:
         try:
@@ -246,30 +997,171 @@ if __name__ == '__main__':
             print("error: zephyr not found")
             sys.exit(1)
 
-    sample_name, sample_path = get_sample_name_path()
-    zephyr_boards = get_boards()
-    flat_boards = flatten(zephyr_boards)
+    return zephyr_commit
+
+def get_boards_to_run():
+    global board_index
+    board_index = load_board_index()
+    with open('artifacts/boards.json', 'w') as f:
+        json.dump(board_index, f, separators=(',', ':'))
+    return filter_boards(board_index)
+
+def filter_boards(index):
+    flat_boards = {name: Board(name, entry['arch'], f"{zephyr_path}/{entry['path']}") for name, entry in index.items()}
     flat_boards = dict(filter(lambda b: "qemu" not in b[0] and "native" not in b[0], flat_boards.items()))
     flat_boards = dict(filter(lambda b: not b[0].startswith("fvp_"), flat_boards.items()))
     boards_to_run = flat_boards.values()
     omit_arch = ('arc', 'posix')
     boards_to_run = filter(lambda x: all(map(lambda y: y != x.arch, omit_arch)), boards_to_run)
     omit_board = ('acrn', 'qemu', 'native', 'nsim', 'xenvm', 'xt-sim')
-    boards_to_run = list(filter(lambda x: all(map(lambda y: y not in x.name, omit_board)), boards_to_run))
-    total_boards = len(boards_to_run)
+    return list(filter(lambda x: all(map(lambda y: y not in x.name, omit_board)), boards_to_run))
+
+def get_shards(boards_to_run):
+    # balanced by the time the boards took to build and simulate before, for all samples
+    board_names = [board.name for board in boards_to_run]
+    durations = collections.Counter()
+    for build_history in build_histories.values():
+        durations.update(history.get_durations(board_names, build_history, 'build_duration', 'sim_duration'))
+    return history.get_shards({board_name: durations[board_name] for board_name in board_names}, shard_count)
+
+def get_boards_in_shard(boards_to_run):
+    if shard_count == 1:
+        return boards_to_run
+    # the prepare job splits the boards once for all shard jobs of the commit,
+    # which would split them differently if one of them missed the history
+    if os.path.exists(shards_filename):
+        with open(shards_filename) as f:
+            shards = json.load(f)
+    else:
+        shards = get_shards(boards_to_run)
+    unassigned = [board.name for board in boards_to_run if board.name not in shards]
+    if len(unassigned) > 0:
+        print(red(f"error: {len(unassigned)} boards are in no shard of {shards_filename}: {', '.join(unassigned)}"))
+        sys.exit(1)
+    # passed on with the artifacts, merge_shards.py checks all shards used the same
+    with open('artifacts/shards.json', 'w') as f:
+        json.dump(shards, f, separators=(',', ':'))
+    boards_in_shard = [board for board in boards_to_run if shards[board.name] == shard_index]
+    print(f"Shard {bold(str(shard_index + 1))} of {shard_count}: {bold(str(len(boards_in_shard)))} of {len(boards_to_run)} boards")
+    return boards_in_shard
+
+def serialize_board(board):
+    serialized = {
+        "name": board.name,
+        "full_name": board_index[board.name]["full_name"],
+        "arch": board.arch,
+        "path": get_board_path(board)
+    }
+    if shard_count > 1:
+        serialized["shard"] = shard_index
+    return serialized
+
+def get_build_status(board_name, sample_name, info=None):
+    if info is not None and 'status' in info:
+        return info['status']
+    # artifacts reused from an earlier build
+    return 'BUILT' if os.path.exists(f"artifacts/{board_name}-{sample_name}/{board_name}-zephyr-{sample_name}.elf") else 'FAILED'
+
+def update_build_history(build_info, sample_name):
+    new_history = dict(build_histories[sample_name])
+    for board_name, info in build_info.items():
+        entry = new_history.setdefault(board_name, {})
+        if info['flash'] is not None and info['flash']['flash_overflow'] > 0:
+            entry['flash'] = info['flash']
+        else:
+            entry.pop('flash', None)
+        if info.get('build_rss'):
+            entry['build_rss'] = info['build_rss']
+        if 'build_duration' in info:
+            entry['build_duration'] = info['build_duration']
+    return new_history
+
+def get_built_boards_path(sample_name=None):
+    # there is one list per sample when several samples are built together
+    if sample_name is None:
+        return "artifacts/built_boards.json"
+    return f"artifacts/built_boards-{sample_name}.json"
+
+def save_built_boards(boards_to_serialize, sample_name=None):
+    with open(get_built_boards_path(sample_name), "w") as file:
+        json.dump(boards_to_serialize, file)
+
+
+if __name__ == '__main__':
+    write_zephyr_version()
+
+    samples_to_build = get_samples_to_build()
+    job_name = 'build-' + '-'.join(sample_name for sample_name, _ in samples_to_build) + (f'-{shard_index}' if shard_count > 1 else '')
+    tracing.start(job_name)
+    build_histories = {sample_name: history.load_history(sample_name, previous_artifacts) for sample_name, _ in samples_to_build}
+    boards_to_run = get_boards_in_shard(get_boards_to_run())
+    flat_boards = {board.name: board for board in boards_to_run}
     thread_number = int(os.getenv("NUMBER_OF_THREADS", 1))
 
+    # the (board, sample) pairs of all samples are built in one pool
+    unsimulable_boards = {}
+    reusable_boards = {}
+    built_boards = {}
+    tasks = []
+    durations = {}
+    for sample_name, sample_path in samples_to_build:
+        with tracing.span('prefilter', sample=sample_name):
+            unsimulable_boards[sample_name] = get_unsimulable_boards(boards_to_run, sample_name, sample_path, thread_number)
+        reusable_boards[sample_name] = get_reusable_boards([board for board in boards_to_run if board.name not in unsimulable_boards[sample_name]], sample_name, sample_path)
+        for board_name in reusable_boards[sample_name]:
+            reuse_artifacts(board_name, sample_name)
+        built_boards[sample_name] = {entry['name']: entry['info'] for entry in checkpoint.start(f'built_boards-{sample_name}')}
+        if len(built_boards[sample_name]) > 0:
+            print(f"Resuming, {bold(str(len(built_boards[sample_name])))} boards were already built for {sample_name}")
+        boards_to_build = [board.name for board in boards_to_run if board.name not in reusable_boards[sample_name] and board.name not in unsimulable_boards[sample_name] and board.name not in built_boards[sample_name]]
+        tasks += [(board_name, sample_name, sample_path) for board_name in boards_to_build]
+        for board_name, duration in history.get_durations(boards_to_build, build_histories[sample_name], 'build_duration').items():
+            durations[board_name, sample_name] = duration
+    tasks.sort(key=lambda task: durations[task[0], task[1]], reverse=True)
+    total_boards = len(tasks)
+
+    if spdx_mode == 'deferred':
+        spdx_workers = start_spdx_workers(int(os.getenv("SPDX_JOBS", max(1, thread_number // 8))))
+        # the SBOMs of the interrupted run might not have been generated yet
+        for sample_name, _ in samples_to_build:
+            for board_name in built_boards[sample_name]:
+                if not os.path.exists(f"artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-app.spdx"):
+                    spdx_queue.put((board_name, sample_name, os.environ.copy()))
+
+    if build_scheduler:
+        start_build_scheduler()
+    sampler.start(job_name, {'build': thread_number})
     with parallel_backend('multiprocessing', n_jobs=thread_number):
-        Parallel()(delayed(loop_wrapper)(board, i, total_boards, sample_name, sample_path) for i, board in enumerate(boards_to_run, start=1))
-
-    boards_to_serialize = []
-    for board in boards_to_run:
-        boards_to_serialize.append({
-            "name": board.name,
-            "full_name": get_full_name(get_board_yaml_path(board.name, get_board_path(board))),
-            "arch": board.arch,
-            "path": get_board_path(board)
-            })
-    with open("artifacts/built_boards.json", "w") as file:
-        json.dump(boards_to_serialize, file)
+        results = Parallel()(delayed(loop_wrapper)(board_name, i, total_boards, sample_name, sample_path) for i, (board_name, sample_name, sample_path) in enumerate(tasks, start=1))
+    build_info = {sample_name: dict(built_boards[sample_name]) for sample_name, _ in samples_to_build}
+    for (board_name, sample_name, _), info in zip(tasks, results):
+        build_info[sample_name][board_name] = info
+
+    if spdx_mode == 'deferred':
+        stop_spdx_workers(spdx_workers)
+    sampler.stop()
+
+    for sample_name, _ in samples_to_build:
+        boards_to_serialize = []
+        for board in boards_to_run:
+            boards_to_serialize.append(serialize_board(board))
+            boards_to_serialize[-1]["reused"] = board.name in reusable_boards[sample_name]
+            if board.name in unsimulable_boards[sample_name]:
+                boards_to_serialize[-1]["skipped"] = unsimulable_boards[sample_name][board.name]
+            else:
+                boards_to_serialize[-1]["build_status"] = get_build_status(board.name, sample_name, build_info[sample_name].get(board.name))
+            if board.name in build_info[sample_name] and 'build_duration' in build_info[sample_name][board.name]:
+                boards_to_serialize[-1]["build_duration"] = build_info[sample_name][board.name]["build_duration"]
+            # entries resumed from a run without BUILD_CACHE have no stats
+            if build_cache is not None and build_info[sample_name].get(board.name, {}).get("build_cache") is not None:
+                boards_to_serialize[-1]["build_cache"] = build_info[sample_name][board.name]["build_cache"]
+        save_built_boards(boards_to_serialize, sample_name if len(samples_to_build) > 1 else None)
+        history.save_history(update_build_history(build_info[sample_name], sample_name), sample_name)
+    tracing.finish()
+    transfer.write_manifest('artifacts')
 
+    if artifact_store is not None:
+        artifact_store.evict()
+    if build_cache is not None:
+        print_build_cache_stats([info.get("build_cache") for sample_info in build_info.values() for info in sample_info.values() if info.get("build_cache") is not None])
+        evict_build_cache()
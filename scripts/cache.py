@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+def hash_data(*items):
+    h = hashlib.sha256()
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode()
+        h.update(hashlib.sha256(item).digest())
+    return h.hexdigest()
+
+def hash_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# every entry is a JSON document plus an optional set of files, kept in its
+# own directory; entries are renamed into place so that parallel workers
+# never see half-written ones, and reading an entry refreshes its mtime,
+# which is what LRU eviction is based on
+class DirectoryStore:
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, 'entry.json')) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(entry)
+        return data
+
+    def get_file(self, key, name, dest):
+        src = os.path.join(self.entry_path(key), 'files', name)
+        if not os.path.exists(src):
+            return False
+        shutil.copy2(src, dest)
+        return True
+
+    def put(self, key, data, files={}):
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        os.makedirs(os.path.join(tmp, 'files'))
+        for name, filename in files.items():
+            shutil.copy2(filename, os.path.join(tmp, 'files', name))
+        with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(data, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker stored the same entry in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        for prefix in os.listdir(self.path):
+            prefix = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix):
+                continue
+            for key in os.listdir(prefix):
+                entry = os.path.join(prefix, key)
+                if os.path.exists(os.path.join(entry, 'entry.json')):
+                    yield entry
+
+    def evict(self):
+        # drop the least recently used entries until the store fits in max_size
+        if self.max_size is None:
+            return 0
+        entries = []
+        for entry in self.entries():
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+            evicted += 1
+        return evicted
+
+# immutable files kept once under their content hash; artifacts are hardlinks
+# to them, so the same ELF, DTS or config built for several samples or commits
+# only takes space once. Blobs are never written to after they're added and an
+# artifact is always replaced by unlinking it first.
+class BlobStore:
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def add(self, src, digest=None):
+        if digest is None:
+            digest = hash_file(src)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(blob))
+            os.close(fd)
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, blob)
+        return digest
+
+    def link(self, src, dest):
+        digest = self.add(src)
+        self.link_blob(digest, dest)
+        return digest
+
+    def link_blob(self, digest, dest):
+        blob = self.blob_path(digest)
+        os.utime(blob)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(blob, dest)
+        except OSError:
+            # different filesystem
+            shutil.copyfile(blob, dest)
+
+    def evict(self):
+        # drop the least recently linked blobs; existing artifacts keep their own link
+        if self.max_size is None:
+            return 0
+        blobs = []
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                blob = os.path.join(root, f)
+                blobs.append((os.path.getmtime(blob), os.path.getsize(blob), blob))
+        total_size = sum(size for _, size, _ in blobs)
+        evicted = 0
+        for _, size, blob in sorted(blobs):
+            if total_size <= self.max_size:
+                break
+            os.remove(blob)
+            total_size -= size
+            evicted += 1
+        return evicted
+
+# cache backends by location scheme; a location without a scheme is a local directory
+stores = {
+    'file': DirectoryStore,
+}
+
+def open_store(location, max_size=None):
+    if location is None or location == '':
+        return None
+    scheme, sep, path = location.partition('://')
+    if not sep:
+        scheme, path = 'file', location
+    if scheme not in stores:
+        print(f"Unsupported cache location {location}, caching disabled")
+        return None
+    return stores[scheme](path, max_size)
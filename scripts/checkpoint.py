@@ -0,0 +1,43 @@
+import fcntl
+import json
+import os
+
+# progress of a run, one JSON line per finished board, so that a run which was
+# interrupted can be resumed (RESUME=1) without redoing the boards it finished;
+# in CI run_resumable.sh saves the logs and sets it when a job is retried
+
+resume = os.getenv('RESUME', '0') == '1'
+
+def get_checkpoint_path(name, directory='artifacts'):
+    return os.path.join(directory, f'{name}.jsonl')
+
+def append(name, entry, directory='artifacts'):
+    os.makedirs(directory, exist_ok=True)
+    # several workers append to the same file, each line has to be written at once
+    with open(get_checkpoint_path(name, directory), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def load(name, directory='artifacts'):
+    entries = []
+    try:
+        with open(get_checkpoint_path(name, directory)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the line being written when the run was interrupted
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+def start(name, directory='artifacts'):
+    # entries of the previous attempt when resuming, otherwise a fresh log
+    if resume:
+        return load(name, directory)
+    if os.path.exists(get_checkpoint_path(name, directory)):
+        os.remove(get_checkpoint_path(name, directory))
+    return []
@@ -11,40 +11,190 @@ UBUNTU_VERSION = 'jammy'
 ZEPHYR_SDK_VERSION = '0.15.0'
 RENODE_VERSION = '1.13.1+20220909git3e7a1aa7'
 LAST_ZEPHYR_COMMIT_FILE = 'last_zephyr_commit'
+# build and simulate each (commit, sample) in a single pipelined job
+PIPELINE = False
+NUMBER_OF_THREADS_PIPELINE = 32
+# reuse artifacts of the last built commit for boards unaffected by the changes
+CHANGE_IMPACT = False
+# don't build boards which can't be simulated
+PREFILTER = False
+# start builds by the free CPU and memory of the node, each with a share of the
+# CPUs, instead of running NUMBER_OF_THREADS builds with full ninja parallelism
+BUILD_SCHEDULER = True
+# generate SBOMs in a low-priority pool next to the builds
+SPDX_MODE = 'deferred'
+# pass artifacts from build to simulate jobs as content-addressed blobs, see transfer.py
+DELTA_TRANSFER = False
+BUCKET = 'gs://gcp-distributed-job-test-bucket'
+# days the blobs no manifest refers to are kept for, so that the next runs can reuse them
+BLOB_RETENTION_DAYS = 7
+# split the boards of each (commit, sample) between this many build and simulate
+# jobs, balanced by the durations of the previous run, and merge their artifacts
+SHARDS = 1
+# build all samples of a commit in one job over one prepared Zephyr tree, with
+# a simulate job per sample; not used with PIPELINE
+BUILD_SAMPLES_TOGETHER = False
+# save the artifacts of the build, simulate and pipeline scripts while they run,
+# so that a retried job (e.g. after a preempted node) resumes them, see run_resumable.sh
+RESUME_RETRIED_JOBS = True
 
-def generate():
-    commit_sample_product = list(itertools.product(range(MAX_NUMBER_OF_COMMITS), SAMPLES))
-    tasks = []
-    for zephyr_commit in range(MAX_NUMBER_OF_COMMITS):
-        tasks.append(f'''
-  prepare-zephyr-{zephyr_commit}:
+def get_shard(shard):
+    # job name suffix and environment of a shard
+    if SHARDS == 1:
+        return '', ''
+    return f'-{shard}', f'''
+      SHARD_INDEX: {shard}
+      SHARD_COUNT: {SHARDS}'''
+
+def get_save_results(stage_job, zephyr_commit, sample, shard):
+    if SHARDS == 1:
+        return './scripts/save_artifacts.sh artifacts/ ${{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}'
+    # the merge job saves the artifacts of all shards together
+    return f'./scripts/save_artifacts.sh artifacts/ job-artifacts/{stage_job}-{zephyr_commit}-{sample}-{shard}'
+
+def get_resumable(job_name, command):
+    if not RESUME_RETRIED_JOBS:
+        return command
+    return f'./scripts/run_resumable.sh {job_name} {command}'
+
+def get_prepared_inputs(zephyr_commit):
+    # what the prepare job passes on to the jobs building its commit
+    prepared = f'gs://gcp-distributed-job-test-bucket/job-artifacts/prepare-zephyr-{zephyr_commit}'
+    inputs = f'''
+        gsutil cp {prepared}/zephyr.tar.gz .
+        gsutil -m cp -r {prepared}/board_index .'''
+    if PREFILTER:
+        inputs += f'''
+        gsutil -m cp -r {prepared}/prefilter_cache .'''
+    return inputs
+
+def get_board_checks(zephyr_commit):
+    # the board index, and with PREFILTER the board checks and with SHARDS the
+    # split of the boards between the shard jobs, are made once per commit
+    index_boards = './scripts/index_boards.py'
+    passed_dirs = 'board_index'
+    if PREFILTER:
+        index_boards = f'''apt -qqy install cpp
+        PREFILTER=1 PREFILTER_CACHE=prefilter_cache {index_boards}'''
+        passed_dirs += ' prefilter_cache'
+    if SHARDS > 1:
+        histories = '\n'.join(f'        gsutil cp "gs://gcp-distributed-job-test-bucket/$(cat {LAST_ZEPHYR_COMMIT_FILE})/artifacts/history-{sample}.json" previous_artifacts/ || true' for sample in SAMPLES)
+        index_boards = f'''mkdir -p previous_artifacts
+{histories}
+        {index_boards.replace('./scripts/index_boards.py', f'SHARD_COUNT={SHARDS} PREVIOUS_ARTIFACTS=previous_artifacts ./scripts/index_boards.py')}'''
+    return f'''
+        {index_boards}
+        rm -f board_index/boards-previous.json
+        mkdir -p job-artifacts/prepare-zephyr-{zephyr_commit}
+        mv {passed_dirs} job-artifacts/prepare-zephyr-{zephyr_commit}/'''
+
+def get_build_inputs(sample_names):
+    # previous artifacts step and environment of a job building the given samples
+    previous_artifacts_step = f'''
+    - name: Get previous artifacts
+      if: env.SKIP != 'true'
+      run: |
+        mkdir -p previous_artifacts'''
+    for sample in sample_names:
+        previous_artifacts_step += f'''
+        gsutil cp "gs://gcp-distributed-job-test-bucket/$(cat {LAST_ZEPHYR_COMMIT_FILE})/artifacts/history-{sample}.json" previous_artifacts/ || true'''
+    build_env = '''
+      PREVIOUS_ARTIFACTS: previous_artifacts'''
+    if BUILD_SCHEDULER:
+        build_env += '''
+      BUILD_SCHEDULER: 1'''
+    if CHANGE_IMPACT:
+        for sample in sample_names:
+            previous_artifacts_step += f'''
+        gsutil -m cp -r "gs://gcp-distributed-job-test-bucket/$(cat {LAST_ZEPHYR_COMMIT_FILE})/artifacts/*-{sample}" previous_artifacts/ || true'''
+        build_env += '''
+      CHANGE_IMPACT: 1'''
+    if PREFILTER:
+        if not CHANGE_IMPACT:
+            # the DTS generated for every board by the previous build, checked by the prefilter
+            for sample in sample_names:
+                previous_artifacts_step += f'''
+        gsutil -m rsync -r -x '^(?!.*-{sample}/[^/]*-{sample}\\.dts$)' "gs://gcp-distributed-job-test-bucket/$(cat {LAST_ZEPHYR_COMMIT_FILE})/artifacts" previous_artifacts/ || true'''
+        build_env += '''
+      PREFILTER: 1
+      PREFILTER_CACHE: prefilter_cache'''
+    return previous_artifacts_step, build_env
+
+def generate_pipeline_job(zephyr_commit, sample, shard, previous_artifacts_step, build_env):
+    suffix, shard_env = get_shard(shard)
+    save_results = get_save_results('pipeline', zephyr_commit, sample, shard)
+    return f'''
+  pipeline-{zephyr_commit}-{sample}{suffix}:
     container: ubuntu:{UBUNTU_VERSION}
     runs-on: [self-hosted, Linux, X64]
+    needs: [prepare-zephyr-{zephyr_commit}]
+    outputs:
+      ZEPHYR_COMMIT: ${{{{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}}}
     env:
-      ZEPHYR_COMMIT: {zephyr_commit}
-      ZEPHYR_SDK_VERSION: {ZEPHYR_SDK_VERSION}
-      GHA_SA: "gh-sa-gcp-distributed-job-buck"
+      SAMPLE_NAME: {sample}
+      MICROPYTHON_VERSION: 97a7cc243b
+      RENODE_VERSION: {RENODE_VERSION}
+      NUMBER_OF_THREADS: {NUMBER_OF_THREADS_PIPELINE}
+      GHA_MACHINE_TYPE: "n2-standard-32"
+      GHA_SA: "gh-sa-gcp-distributed-job-buck"{build_env}{shard_env}
     steps:
     - uses: actions/checkout@v2
     - name: Prepare environment
-      run: ./scripts/environment_prepare.sh
-    - name: Download Zephyr
-      run: ./scripts/download_zephyr.sh
-    - name: Pass Zephyr as artifact
+      run: |
+        ./scripts/environment_build.sh
+        pip3 install -r requirements_simulate.txt
+    - name: Check for skip
+      run: ./scripts/check_for_skip.sh {zephyr_commit}
+    - name: Get Zephyr
       if: env.SKIP != 'true'
-      run: ./scripts/save_artifacts.sh zephyr.tar.gz job-artifacts/prepare-zephyr-{zephyr_commit}''')
-    for zephyr_commit, sample in commit_sample_product:
-        tasks.append(f'''
-  build-{zephyr_commit}-{sample}:
+      run: |{get_prepared_inputs(zephyr_commit)}
+    - name: Prepare Zephyr
+      if: env.SKIP != 'true'
+      run: ./scripts/prepare_zephyr.sh
+    - name: Prepare Micropython
+      if: env.SKIP != 'true'
+      run: ./scripts/prepare_micropython.sh{previous_artifacts_step}
+    - name: Prepare Renode
+      if: env.SKIP != 'true'
+      run: ./scripts/download_renode.sh
+    - name: Build and simulate boards
+      if: env.SKIP != 'true'
+      run: {get_resumable(f'pipeline-{zephyr_commit}-{sample}{suffix}', './scripts/pipeline.py')}
+    - name: Get Zephyr commit
+      if: env.SKIP != 'true'
+      id: get-zephyr-commit
+      run: |
+        ZEPHYR_COMMIT=$(cat artifacts/zephyr.version)
+        echo "::set-output name=ZEPHYR_COMMIT::$ZEPHYR_COMMIT"
+    - name: Upload load graphs
+      if: env.SKIP != 'true'
+      uses: actions/upload-artifact@v2
+      with:
+        name: plots
+        path: |
+          **/plot_*.svg
+    - name: Upload artifacts
+      if: env.SKIP != 'true'
+      run: {save_results}'''
+
+def generate_build_job(zephyr_commit, build_name, sample_names, shard, previous_artifacts_step, build_env):
+    # builds one sample, or all of them with BUILD_SAMPLES_TOGETHER
+    suffix, shard_env = get_shard(shard)
+    upload_build_artifacts = f'./scripts/save_artifacts.sh artifacts/ job-artifacts/build-{build_name}{suffix}'
+    if DELTA_TRANSFER:
+        upload_build_artifacts = f'./scripts/transfer.py upload artifacts {BUCKET} job-artifacts/build-{build_name}{suffix}'
+    return f'''
+  build-{build_name}{suffix}:
     container: ubuntu:{UBUNTU_VERSION}
     runs-on: [self-hosted, Linux, X64]
     needs: [prepare-zephyr-{zephyr_commit}]
     env:
-      SAMPLE_NAME: {sample}
+      SAMPLE_NAME: {','.join(sample_names)}
       MICROPYTHON_VERSION: 97a7cc243b
       NUMBER_OF_THREADS: {NUMBER_OF_THREADS_BUILD}
+      SPDX: {SPDX_MODE}
       GHA_MACHINE_TYPE: "n2-standard-32"
-      GHA_SA: "gh-sa-gcp-distributed-job-buck"
+      GHA_SA: "gh-sa-gcp-distributed-job-buck"{build_env}{shard_env}
     steps:
     - uses: actions/checkout@v2
     - name: Prepare environment
@@ -53,16 +203,16 @@ def generate():
       run: ./scripts/check_for_skip.sh {zephyr_commit}
     - name: Get Zephyr
       if: env.SKIP != 'true'
-      run: gsutil cp gs://gcp-distributed-job-test-bucket/job-artifacts/prepare-zephyr-{zephyr_commit}/zephyr.tar.gz .
+      run: |{get_prepared_inputs(zephyr_commit)}
     - name: Prepare Zephyr
       if: env.SKIP != 'true'
       run: ./scripts/prepare_zephyr.sh
     - name: Prepare Micropython
       if: env.SKIP != 'true'
-      run: ./scripts/prepare_micropython.sh
+      run: ./scripts/prepare_micropython.sh{previous_artifacts_step}
     - name: Build boards
       if: env.SKIP != 'true'
-      run: ./scripts/build.py
+      run: {get_resumable(f'build-{build_name}{suffix}', './scripts/build.py')}
     - name: Upload load graphs
       if: env.SKIP != 'true'
       uses: actions/upload-artifact@v2
@@ -72,12 +222,30 @@ def generate():
           **/plot_*.svg
     - name: Upload artifacts
       if: env.SKIP != 'true'
-      run: ./scripts/save_artifacts.sh artifacts/ job-artifacts/build-{zephyr_commit}-{sample}''')
-        tasks.append(f'''
-  simulate-{zephyr_commit}-{sample}:
+      run: {upload_build_artifacts}'''
+
+def generate_simulate_job(zephyr_commit, sample, shard, build_name):
+    suffix, shard_env = get_shard(shard)
+    save_results = get_save_results('simulate', zephyr_commit, sample, shard)
+    build_artifacts = f'gs://gcp-distributed-job-test-bucket/job-artifacts/build-{build_name}{suffix}/artifacts'
+    get_build_artifacts = f'gsutil -m cp -r {build_artifacts} .'
+    if BUILD_SAMPLES_TOGETHER:
+        # only the artifacts of this sample, the job saves them with its results
+        get_build_artifacts = f'mkdir -p artifacts && gsutil -m cp -r "{build_artifacts}/*-{sample}" "{build_artifacts}/*-{sample}.json*" "{build_artifacts}/*.version" {build_artifacts}/boards.json artifacts/'
+        if SHARDS > 1:
+            get_build_artifacts = get_build_artifacts.replace(' artifacts/', f' {build_artifacts}/shards.json artifacts/')
+    simulate_env = ''
+    if DELTA_TRANSFER:
+        get_build_artifacts = f'./scripts/transfer.py download {BUCKET} job-artifacts/build-{build_name}{suffix} artifacts --lazy'
+        if BUILD_SAMPLES_TOGETHER:
+            get_build_artifacts += ' && rm -f ' + ' '.join(f'artifacts/built_boards-{other}.json artifacts/history-{other}.json' for other in SAMPLES if other != sample)
+        simulate_env = f'''
+      ARTIFACT_REMOTE: {BUCKET}'''
+    return f'''
+  simulate-{zephyr_commit}-{sample}{suffix}:
     container: ubuntu:{UBUNTU_VERSION}
     runs-on: [self-hosted, Linux, X64]
-    needs: [build-{zephyr_commit}-{sample}]
+    needs: [build-{build_name}{suffix}]
     outputs:
       ZEPHYR_COMMIT: ${{{{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}}}
     env:
@@ -85,7 +253,7 @@ def generate():
       RENODE_VERSION: {RENODE_VERSION}
       NUMBER_OF_THREADS: {NUMBER_OF_THREADS_SIMULATE}
       GHA_SA: "gh-sa-gcp-distributed-job-buck"
-      GHA_MACHINE_TYPE: "n2-standard-32"
+      GHA_MACHINE_TYPE: "n2-standard-32"{simulate_env}{shard_env}
     steps:
     - uses: actions/checkout@v2
     - name: Prepare environment
@@ -94,13 +262,13 @@ def generate():
       run: ./scripts/check_for_skip.sh {zephyr_commit}
     - name: Get artifacts
       if: env.SKIP != 'true'
-      run: gsutil -m cp -r gs://gcp-distributed-job-test-bucket/job-artifacts/build-{zephyr_commit}-{sample}/artifacts .
+      run: {get_build_artifacts}
     - name: Prepare Renode
       if: env.SKIP != 'true'
       run: ./scripts/download_renode.sh
     - name: Simulate
       if: env.SKIP != 'true'
-      run: ./scripts/simulate.py
+      run: {get_resumable(f'simulate-{zephyr_commit}-{sample}{suffix}', './scripts/simulate.py')}
     - name: Get Zephyr commit
       if: env.SKIP != 'true'
       id: get-zephyr-commit
@@ -116,12 +284,101 @@ def generate():
           **/plot_*.svg
     - name: Upload artifacts
       if: env.SKIP != 'true'
-      run: ./scripts/save_artifacts.sh artifacts/ ${{{{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}}}''')
+      run: {save_results}'''
+
+def generate_merge_job(zephyr_commit, sample, stage_job):
+    # combines the artifacts of the shards and saves them like an unsharded job would
+    shard_dirs = '\n'.join(f'        mkdir -p shards/{shard} && gsutil -m cp -r gs://gcp-distributed-job-test-bucket/job-artifacts/{stage_job}-{zephyr_commit}-{sample}-{shard}/artifacts shards/{shard}/' for shard in range(SHARDS))
+    return f'''
+  merge-{zephyr_commit}-{sample}:
+    container: ubuntu:{UBUNTU_VERSION}
+    runs-on: [self-hosted, Linux, X64]
+    needs: [{", ".join(f'{stage_job}-{zephyr_commit}-{sample}-{shard}' for shard in range(SHARDS))}]
+    outputs:
+      ZEPHYR_COMMIT: ${{{{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}}}
+    env:
+      GHA_SA: "gh-sa-gcp-distributed-job-buck"
+    steps:
+    - uses: actions/checkout@v2
+    - name: Prepare environment
+      run: ./scripts/environment_simulate.sh
+    - name: Check for skip
+      run: ./scripts/check_for_skip.sh {zephyr_commit}
+    - name: Get shard artifacts
+      if: env.SKIP != 'true'
+      run: |
+{shard_dirs}
+    - name: Merge shards
+      if: env.SKIP != 'true'
+      run: ./scripts/merge_shards.py {sample} artifacts {' '.join(f'shards/{shard}/artifacts' for shard in range(SHARDS))}
+    - name: Get Zephyr commit
+      if: env.SKIP != 'true'
+      id: get-zephyr-commit
+      run: |
+        ZEPHYR_COMMIT=$(cat artifacts/zephyr.version)
+        echo "::set-output name=ZEPHYR_COMMIT::$ZEPHYR_COMMIT"
+    - name: Upload artifacts
+      if: env.SKIP != 'true'
+      run: ./scripts/save_artifacts.sh artifacts/ ${{{{ steps.get-zephyr-commit.outputs.ZEPHYR_COMMIT }}}}'''
+
+def generate():
+    commit_sample_product = list(itertools.product(range(MAX_NUMBER_OF_COMMITS), SAMPLES))
+    tasks = []
+    delete_blobs = ''
+    if DELTA_TRANSFER:
+        delete_blobs = f'''
+    - name: Delete old blobs
+      run: ./scripts/transfer.py gc {BUCKET} {BLOB_RETENTION_DAYS}'''
+    for zephyr_commit in range(MAX_NUMBER_OF_COMMITS):
+        tasks.append(f'''
+  prepare-zephyr-{zephyr_commit}:
+    container: ubuntu:{UBUNTU_VERSION}
+    runs-on: [self-hosted, Linux, X64]
+    env:
+      ZEPHYR_COMMIT: {zephyr_commit}
+      ZEPHYR_SDK_VERSION: {ZEPHYR_SDK_VERSION}
+      GHA_SA: "gh-sa-gcp-distributed-job-buck"
+    steps:
+    - uses: actions/checkout@v2
+    - name: Prepare environment
+      run: ./scripts/environment_prepare.sh
+    - name: Download Zephyr
+      run: ./scripts/download_zephyr.sh
+    - name: Index boards
+      if: env.SKIP != 'true'
+      run: |
+        pip3 install -r requirements_build.txt
+        mkdir -p board_index
+        gsutil cp "gs://gcp-distributed-job-test-bucket/$(cat {LAST_ZEPHYR_COMMIT_FILE})/artifacts/boards.json" board_index/boards-previous.json || true{get_board_checks(zephyr_commit)}
+    - name: Pass Zephyr as artifact
+      if: env.SKIP != 'true'
+      run: ./scripts/save_artifacts.sh zephyr.tar.gz job-artifacts/prepare-zephyr-{zephyr_commit}''')
+    stage_job = 'pipeline' if PIPELINE else 'simulate'
+    final_job = 'merge' if SHARDS > 1 else stage_job
+    for zephyr_commit in range(MAX_NUMBER_OF_COMMITS):
+        build_together = BUILD_SAMPLES_TOGETHER and not PIPELINE
+        if build_together:
+            previous_artifacts_step, build_env = get_build_inputs(SAMPLES)
+            for shard in range(SHARDS):
+                tasks.append(generate_build_job(zephyr_commit, f'{zephyr_commit}', SAMPLES, shard, previous_artifacts_step, build_env))
+        for sample in SAMPLES:
+            if not build_together:
+                previous_artifacts_step, build_env = get_build_inputs([sample])
+            for shard in range(SHARDS):
+                if PIPELINE:
+                    tasks.append(generate_pipeline_job(zephyr_commit, sample, shard, previous_artifacts_step, build_env))
+                    continue
+                build_name = f'{zephyr_commit}' if build_together else f'{zephyr_commit}-{sample}'
+                if not build_together:
+                    tasks.append(generate_build_job(zephyr_commit, build_name, [sample], shard, previous_artifacts_step, build_env))
+                tasks.append(generate_simulate_job(zephyr_commit, sample, shard, build_name))
+            if SHARDS > 1:
+                tasks.append(generate_merge_job(zephyr_commit, sample, stage_job))
     tasks.append(f'''
   results:
     container: ubuntu:{UBUNTU_VERSION}
     runs-on: [self-hosted, Linux, X64]
-    needs: [{", ".join([f'simulate-{zephyr_commit}-{sample}' for zephyr_commit, sample in commit_sample_product])}]
+    needs: [{", ".join([f'{final_job}-{zephyr_commit}-{sample}' for zephyr_commit, sample in commit_sample_product])}]
     env:
       GHA_SA: "gh-sa-gcp-distributed-job-buck"
       DEBIAN_FRONTEND: noninteractive
@@ -132,11 +389,11 @@ def generate():
     - name: Install gcp
       run: ./scripts/prepare_gcp.sh
     - name: Delete artifacts
-      run: ./scripts/delete_artifacts.sh
+      run: ./scripts/delete_artifacts.sh{delete_blobs}
     - name: Update latest Zephyr commit
       id: update-last-zephyr-commit
       run: |
-        ./scripts/save_commit.sh {' '.join([f'${{{{ needs.simulate-{commit}-{sample}.outputs.ZEPHYR_COMMIT }}}}' for commit, sample in commit_sample_product])}
+        ./scripts/save_commit.sh {' '.join([f'${{{{ needs.{final_job}-{commit}-{sample}.outputs.ZEPHYR_COMMIT }}}}' for commit, sample in commit_sample_product])}
         echo "::set-output name=LAST_ZEPHYR_COMMIT::$(cat last_zephyr_commit)"
     - name: Commit latest Zephyr commit
       uses: stefanzweifel/git-auto-commit-action@v4
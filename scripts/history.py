@@ -0,0 +1,49 @@
+import json
+import os
+
+# facts about every board gathered by earlier runs (flash overflows, timings
+# and so on), kept as artifacts/history-<sample>.json and carried over from
+# the artifacts of the previous run
+
+def get_history_path(sample_name, directory='artifacts'):
+    return os.path.join(directory, f'history-{sample_name}.json')
+
+def load_history(sample_name, directory='artifacts'):
+    if directory is None:
+        return {}
+    try:
+        with open(get_history_path(sample_name, directory)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_history(history, sample_name, directory='artifacts'):
+    with open(get_history_path(sample_name, directory), 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+def get_durations(board_names, history, *keys):
+    # the median is assumed for boards without history
+    durations = {board_name: sum(history.get(board_name, {}).get(key, 0) for key in keys) for board_name in board_names}
+    known = sorted(duration for board_name, duration in durations.items() if all(key in history.get(board_name, {}) for key in keys))
+    default = known[len(known) // 2] if len(known) > 0 else 1
+    for board_name in board_names:
+        if not all(key in history.get(board_name, {}) for key in keys):
+            durations[board_name] = default
+    return durations
+
+def longest_first(board_names, history, *keys):
+    # the boards which took the longest in the previous runs go first, so that
+    # none of them is left running alone at the end
+    durations = get_durations(board_names, history, *keys)
+    return sorted(board_names, key=lambda board_name: durations[board_name], reverse=True)
+
+def get_shards(durations, shard_count):
+    # every board goes to the shard with the least work so far, longest first,
+    # so that the shards finish at about the same time
+    loads = [0] * shard_count
+    shards = {}
+    for board_name in sorted(durations, key=lambda board_name: durations[board_name], reverse=True):
+        shard = loads.index(min(loads))
+        shards[board_name] = shard
+        loads[shard] += durations[board_name]
+    return shards
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# collects the board metadata of the prepared Zephyr tree once, in the prepare
+# job, for all the build and pipeline jobs of that commit (see load_board_index);
+# with PREFILTER the simulability checks of the boards are stored in
+# PREFILTER_CACHE for them as well, and with SHARD_COUNT > 1 the boards are
+# split between the shards by the histories of all samples in PREVIOUS_ARTIFACTS
+
+import json
+import os
+
+import build
+import history
+
+if __name__ == '__main__':
+    index = build.load_board_index()
+    print(f"Indexed {build.bold(str(len(index)))} boards in {build.board_index_dir}")
+    if os.getenv('PREFILTER'):
+        build.board_index = index
+        boards = [build.Board(name, entry['arch'], f"{build.zephyr_path}/{entry['path']}") for name, entry in index.items()]
+        checked = build.check_boards(boards, int(os.getenv('NUMBER_OF_THREADS', os.cpu_count() or 1)))
+        print(f"Checked {build.bold(str(len(checked)))} boards, {sum(reason is not None for reason in checked.values())} can't be simulated")
+    if build.shard_count > 1:
+        build.build_histories = {sample_name: history.load_history(sample_name, build.previous_artifacts) for sample_name, _ in build.samples}
+        shards = build.get_shards(build.filter_boards(index))
+        with open(build.shards_filename, 'w') as f:
+            json.dump(shards, f, separators=(',', ':'))
+        print(f"Split {build.bold(str(len(shards)))} boards between {build.shard_count} shards")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Combines the artifacts of the shards of a sample (SHARD_COUNT > 1) into one
+# artifacts directory, as if all boards were built and simulated by one job.
+#
+#   merge_shards.py <sample> <directory> <shard directory>...
+#
+# The board directories of the shards are disjoint and are moved as they are;
+# the lists of built boards, the results, the histories and the progress logs
+# are joined and the simulation cache statistics summed up. The shards must have
+# split the boards the same way, as in the shards.json of the prepare job, and
+# every board must have been built by exactly the shard it was given to,
+# otherwise nothing is merged.
+
+import collections
+import json
+import os
+import shutil
+import sys
+
+import history
+import transfer
+
+def load_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def check_shards(shard_dirs, assignment, boards_by_shard, results_by_shard):
+    errors = []
+    for shard, shard_dir in enumerate(shard_dirs):
+        shard_assignment = load_json(os.path.join(shard_dir, 'shards.json'), None)
+        if shard_assignment is None:
+            errors.append(f"{shard_dir} has no shards.json")
+        elif shard_assignment != assignment:
+            errors.append(f"{shard_dir} split the boards differently than {shard_dirs[0]}")
+    if assignment is None:
+        return errors
+    for name, shard_boards in boards_by_shard.items():
+        found = collections.defaultdict(list)
+        for shard, boards in shard_boards.items():
+            for board in boards:
+                found[board['name']].append(shard)
+        for board_name, shard in assignment.items():
+            if board_name not in found:
+                errors.append(f"{board_name} of shard {shard} is missing from {name}")
+        for board_name, shards in found.items():
+            if len(shards) > 1:
+                errors.append(f"{board_name} is in {name} of shards {', '.join(map(str, shards))}")
+            elif assignment.get(board_name) != shards[0]:
+                errors.append(f"{board_name} is in {name} of shard {shards[0]}, but was given to shard {assignment.get(board_name)}")
+    for name, shard_results in results_by_shard.items():
+        found = collections.defaultdict(list)
+        for shard, results in shard_results.items():
+            for result in results:
+                found[result['board_name']].append(shard)
+        for board_name, shards in found.items():
+            if len(shards) > 1 or assignment.get(board_name) != shards[0]:
+                errors.append(f"{board_name} has results in {name} of shards {', '.join(map(str, shards))}, but was given to shard {assignment.get(board_name)}")
+    return errors
+
+def merge(sample_name, directory, shard_dirs):
+    assignment = load_json(os.path.join(shard_dirs[0], 'shards.json'), None)
+    boards_by_shard = {}
+    results_by_shard = {}
+    for shard, shard_dir in enumerate(shard_dirs):
+        for name in os.listdir(shard_dir):
+            if name.startswith('built_boards') and name.endswith('.json'):
+                boards_by_shard.setdefault(name, {})[shard] = load_json(os.path.join(shard_dir, name), [])
+        for name in os.listdir(os.path.join(shard_dir, 'results')) if os.path.isdir(os.path.join(shard_dir, 'results')) else []:
+            if name.startswith('results-'):
+                results_by_shard.setdefault(name, {})[shard] = load_json(os.path.join(shard_dir, 'results', name), [])
+    errors = check_shards(shard_dirs, assignment, boards_by_shard, results_by_shard)
+    if len(errors) > 0:
+        for error in errors:
+            print(f"error: {error}")
+        print(f"Not merging {len(shard_dirs)} shards, {len(errors)} errors")
+        sys.exit(1)
+
+    os.makedirs(os.path.join(directory, 'results'), exist_ok=True)
+    # built_boards.json, or one list per sample if the build job built several
+    built_boards = {}
+    results = {}
+    sim_cache_stats = {}
+    histories = {}
+    for shard, shard_dir in enumerate(shard_dirs):
+        shard_boards = {name: boards[shard] for name, boards in boards_by_shard.items() if shard in boards}
+        for name, boards in shard_boards.items():
+            built_boards.setdefault(name, []).extend(boards)
+        for name in os.listdir(os.path.join(shard_dir, 'results')) if os.path.isdir(os.path.join(shard_dir, 'results')) else []:
+            if name.startswith('results-'):
+                results.setdefault(name, []).extend(results_by_shard[name][shard])
+            elif name.startswith('sim-cache-'):
+                stats = sim_cache_stats.setdefault(name, {})
+                for key, value in load_json(os.path.join(shard_dir, 'results', name), {}).items():
+                    stats[key] = stats.get(key, 0) + value
+            elif not os.path.exists(os.path.join(directory, 'results', name)):
+                # e.g. the trace summaries, which are named after the shard
+                shutil.move(os.path.join(shard_dir, 'results', name), os.path.join(directory, 'results', name))
+
+        for name in os.listdir(shard_dir):
+            src = os.path.join(shard_dir, name)
+            dest = os.path.join(directory, name)
+            if name.startswith('history-') and name.endswith('.json'):
+                # every shard carries the whole history of the previous run, only
+                # the entries of its own boards are up to date
+                history_sample = name[len('history-'):-len('.json')]
+                boards_name = f'built_boards-{history_sample}.json' if f'built_boards-{history_sample}.json' in shard_boards else 'built_boards.json'
+                shard_history = history.load_history(history_sample, shard_dir)
+                merged_history = histories.setdefault(history_sample, {})
+                for board_name, entry in shard_history.items():
+                    merged_history.setdefault(board_name, entry)
+                for board in shard_boards.get(boards_name, []):
+                    if board['name'] in shard_history:
+                        merged_history[board['name']] = shard_history[board['name']]
+            elif name.endswith('.jsonl'):
+                with open(src) as f_src, open(dest, 'a') as f_dest:
+                    shutil.copyfileobj(f_src, f_dest)
+            elif name not in shard_boards and name not in ('results', transfer.manifest_name) and not os.path.exists(dest):
+                # the version files and the board index are the same in every shard
+                shutil.move(src, dest)
+
+    # keep the order of the board index, like an unsharded run
+    order = {board_name: i for i, board_name in enumerate(load_json(os.path.join(directory, 'boards.json'), {}))}
+    for name, boards in built_boards.items():
+        boards.sort(key=lambda board: order.get(board['name'], len(order)))
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(boards, f)
+    for name, shard_results in results.items():
+        shard_results.sort(key=lambda result: order.get(result['board_name'], len(order)))
+        with open(os.path.join(directory, 'results', name), 'w') as f:
+            json.dump(shard_results, f)
+    for name, stats in sim_cache_stats.items():
+        with open(os.path.join(directory, 'results', name), 'w') as f:
+            json.dump(stats, f)
+    for history_sample, merged_history in histories.items():
+        history.save_history(merged_history, history_sample, directory)
+    transfer.write_manifest(directory)
+    print(f"Merged {len(shard_dirs)} shards: {sum(len(boards) for boards in built_boards.values())} boards, {len(results.get(f'results-{sample_name}_all.json', []))} results")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print(f"usage: {sys.argv[0]} <sample> <directory> <shard directory>...")
+        sys.exit(1)
+    merge(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import shutil
+import sys
+
+import build
+import checkpoint
+import history
+import sampler
+import simulate
+import tracing
+import transfer
+
+def build_board(args):
+    board_name, i, total_boards, sample_name, sample_path = args
+    return board_name, build.loop_wrapper(board_name, i, total_boards, sample_name, sample_path)
+
+if __name__ == '__main__':
+    # build and simulate in one job: every board is handed over to the
+    # simulation pool as soon as its build finishes
+    samples_to_build = build.get_samples_to_build()
+    if len(samples_to_build) > 1:
+        # the simulation of a board follows its build, which is done for one sample
+        print(build.red(f"error: the pipeline runs one sample per job, got {os.getenv('SAMPLE_NAME')}"))
+        sys.exit(1)
+    sample_name, sample_path = samples_to_build[0]
+    build.write_zephyr_version()
+    simulate.write_renode_version()
+
+    job_name = f'pipeline-{sample_name}' + (f'-{build.shard_index}' if build.shard_count > 1 else '')
+    tracing.start(job_name)
+    build.build_histories = {sample_name: history.load_history(sample_name, build.previous_artifacts)}
+    boards_to_run = build.get_boards_in_shard(build.get_boards_to_run())
+    build.flat_boards = {board.name: board for board in boards_to_run}
+    simulate.board_index = build.board_index
+    serialized_boards = {board.name: dict(build.serialize_board(board), reused=False) for board in boards_to_run}
+
+    # both pools share the node, so give the builds whatever the simulations don't use
+    thread_number = int(os.getenv("NUMBER_OF_THREADS", 1))
+    sim_jobs = int(os.getenv("SIM_JOBS", max(1, thread_number // 4)))
+    build_jobs = int(os.getenv("BUILD_JOBS", max(1, thread_number - sim_jobs)))
+    simulate.sim_jobs = sim_jobs
+    if build.spdx_mode == 'deferred':
+        # SBOMs are packed right after the simulation of each board, so they can't wait
+        build.spdx_mode = 'inline'
+    print(f"Running {build_jobs} build and {sim_jobs} simulation workers")
+
+    with tracing.span('prefilter', sample=sample_name):
+        unsimulable_boards = build.get_unsimulable_boards(boards_to_run, sample_name, sample_path, thread_number)
+    for board_name, reason in unsimulable_boards.items():
+        serialized_boards[board_name]["skipped"] = reason
+    reusable_boards = build.get_reusable_boards([board for board in boards_to_run if board.name not in unsimulable_boards], sample_name, sample_path)
+    for board_name in reusable_boards:
+        build.reuse_artifacts(board_name, sample_name)
+        serialized_boards[board_name]["reused"] = True
+
+    simulate.sim_history = build.build_histories[sample_name]
+    # boards finished by an interrupted run are neither built nor simulated again
+    built_boards = {entry['name']: entry['info'] for entry in checkpoint.start(f'built_boards-{sample_name}')}
+    simulated_boards = {result['board_name']: result for result in checkpoint.start(f'results-{sample_name}')}
+    if len(built_boards) + len(simulated_boards) > 0:
+        print(f"Resuming, {build.bold(str(len(built_boards)))} boards were already built and {build.bold(str(len(simulated_boards)))} simulated")
+    boards_to_build = [board for board in boards_to_run if board.name not in reusable_boards and board.name not in unsimulable_boards and board.name not in built_boards and board.name not in simulated_boards]
+    boards_to_simulate = [board_name for board_name in list(reusable_boards) + list(unsimulable_boards) + list(built_boards) if board_name not in simulated_boards]
+    # a board is only done once simulated, so order the builds by both stages
+    boards_to_build = [build.flat_boards[board_name] for board_name in history.longest_first([board.name for board in boards_to_build], build.build_histories[sample_name], 'build_duration', 'sim_duration')]
+    boards_to_simulate = history.longest_first(boards_to_simulate, simulate.sim_history, 'sim_duration')
+    tasks = [(board.name, i, len(boards_to_build), sample_name, sample_path) for i, board in enumerate(boards_to_build, start=1)]
+    simulations = {}
+    build_info = dict(built_boards)
+    total_boards = len(boards_to_build) + len(boards_to_simulate)
+    if build.build_scheduler:
+        build.start_build_scheduler()
+    zip_workers = simulate.start_zip_workers(int(os.getenv("ZIP_JOBS", max(1, sim_jobs // 4))))
+    simulate.queue_missing_zip_archives(simulated_boards.values())
+    sampler.start(job_name, {'build': build_jobs, 'simulate': sim_jobs})
+    with multiprocessing.Pool(build_jobs) as build_pool, multiprocessing.Pool(sim_jobs) as sim_pool:
+        for i, board_name in enumerate(boards_to_simulate, start=1):
+            if board_name not in unsimulable_boards:
+                serialized_boards[board_name]["build_status"] = build.get_build_status(board_name, sample_name, build_info.get(board_name))
+            if 'build_duration' in build_info.get(board_name, {}):
+                serialized_boards[board_name]["build_duration"] = build_info[board_name]["build_duration"]
+            simulations[board_name] = sim_pool.apply_async(simulate.loop_wrapper, (serialized_boards[board_name], i, total_boards, sample_name))
+        for i, (board_name, info) in enumerate(build_pool.imap_unordered(build_board, tasks), start=len(boards_to_simulate) + 1):
+            build_info[board_name] = info
+            serialized_boards[board_name]["build_status"] = build.get_build_status(board_name, sample_name, info)
+            serialized_boards[board_name]["build_duration"] = info["build_duration"]
+            simulations[board_name] = sim_pool.apply_async(simulate.loop_wrapper, (serialized_boards[board_name], i, total_boards, sample_name))
+        results = [simulations[board.name].get() for board in boards_to_run if board.name in simulations]
+    simulate.stop_zip_workers(zip_workers)
+    sampler.stop()
+
+    shutil.rmtree('renode_work', ignore_errors=True)
+    simulate.finish_sim_cache(results, sample_name)
+
+    if build.artifact_store is not None:
+        build.artifact_store.evict()
+    if build.build_cache is not None:
+        # entries resumed from a run without BUILD_CACHE have no stats
+        build_stats = {board_name: info.get("build_cache") for board_name, info in build_info.items() if info.get("build_cache") is not None}
+        for board_name, stats in build_stats.items():
+            serialized_boards[board_name]["build_cache"] = stats
+        build.print_build_cache_stats(list(build_stats.values()))
+        build.evict_build_cache()
+    build.save_built_boards([serialized_boards[board.name] for board in boards_to_run])
+    results = simulate.load_results([serialized_boards[board.name] for board in boards_to_run], sample_name)
+    history.save_history(simulate.update_sim_history(build.update_build_history(build_info, sample_name), results), sample_name)
+    simulate.save_results(results, sample_name)
+    tracing.finish()
+    transfer.write_manifest('artifacts')
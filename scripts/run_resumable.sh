@@ -0,0 +1,34 @@
+#!/usr/bin/env bash
+# Runs the build, simulate or pipeline script of a job so that a retried
+# attempt (e.g. after the node was preempted) carries on where the previous one
+# stopped: the artifacts are saved to the bucket every CHECKPOINT_INTERVAL
+# seconds while the script runs and restored with RESUME=1 on the next attempt.
+#
+#   run_resumable.sh <job name> <command>...
+set -e
+set -u
+set -x
+
+PARTIAL_ARTIFACTS=gs://gcp-distributed-job-test-bucket/job-artifacts/partial-$1/artifacts
+shift
+
+if [ "${GITHUB_RUN_ATTEMPT:-1}" -gt 1 ]; then
+    mkdir -p artifacts
+    if gsutil -m -q rsync -r $PARTIAL_ARTIFACTS artifacts/; then
+        export RESUME=1
+    fi
+fi
+
+CHECKPOINTS=$(mktemp -d)
+save_partial_artifacts() {
+    # the progress logs are taken first, so that every board they list has its
+    # files complete by the time the rest is copied
+    cp artifacts/*.jsonl $CHECKPOINTS/ 2>/dev/null || true
+    gsutil -m -q rsync -r -x '.*\.jsonl$' artifacts/ $PARTIAL_ARTIFACTS/ || return 0
+    gsutil -m -q cp $CHECKPOINTS/*.jsonl $PARTIAL_ARTIFACTS/ 2>/dev/null || true
+}
+
+(set +x; while sleep ${CHECKPOINT_INTERVAL:-300}; do save_partial_artifacts; done) &
+SAVER=$!
+trap "kill $SAVER" EXIT
+"$@"
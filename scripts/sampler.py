@@ -0,0 +1,151 @@
+import contextlib
+import multiprocessing
+import os
+import time
+
+# samples the load of the node in a background process while a job runs and
+# draws it as plot_<name>_*.svg at the end: CPU use, memory, the live
+# west/ninja/Renode processes and the busy workers of each pool; samples are
+# taken every SAMPLE_INTERVAL seconds, 0 turns the sampler off
+
+interval = float(os.getenv('SAMPLE_INTERVAL', 2))
+# processes counted by their name
+process_names = {
+    'west': ('west',),
+    'ninja': ('ninja',),
+    'renode': ('renode', 'renode-test'),
+}
+colors = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd')
+# busy workers of each pool, shared with the workers which are forked after start()
+busy_workers = {}
+pool_sizes = {}
+sampler_process = None
+stop_event = None
+
+def get_cpu_times():
+    with open('/proc/stat') as f:
+        times = [int(value) for value in f.readline().split()[1:]]
+    # idle and iowait
+    return sum(times), times[3] + times[4]
+
+def get_used_memory():
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, value = line.split(':')
+            meminfo[name] = int(value.split()[0]) * 1024
+    return meminfo['MemTotal'] - meminfo['MemAvailable']
+
+def get_total_memory():
+    with open('/proc/meminfo') as f:
+        return int(f.readline().split()[1]) * 1024
+
+def count_processes():
+    counts = dict.fromkeys(process_names, 0)
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/comm') as f:
+                comm = f.read().strip().lower()
+        except OSError:
+            # the process is already gone
+            continue
+        for name, comms in process_names.items():
+            if comm in comms:
+                counts[name] += 1
+    return counts
+
+def render_svg(filename, title, times, series, unit, y_max=None):
+    width, height, left, bottom, top, right = 800, 300, 60, 40, 30, 150
+    plot_width, plot_height = width - left - right, height - top - bottom
+    x_max = max(times[-1], 1)
+    if y_max is None:
+        y_max = max([max(values) for values in series.values()] + [1])
+    x = lambda t: left + t / x_max * plot_width
+    y = lambda v: top + plot_height - v / y_max * plot_height
+
+    lines = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="11">',
+             f'<rect width="{width}" height="{height}" fill="white"/>',
+             f'<text x="{width / 2}" y="18" text-anchor="middle" font-size="14">{title}</text>']
+    for i in range(6):
+        value = y_max * i / 5
+        lines.append(f'<line x1="{left}" y1="{y(value):.1f}" x2="{left + plot_width}" y2="{y(value):.1f}" stroke="#ddd"/>')
+        lines.append(f'<text x="{left - 5}" y="{y(value) + 4:.1f}" text-anchor="end">{value:.4g}</text>')
+        t = x_max * i / 5
+        lines.append(f'<text x="{x(t):.1f}" y="{top + plot_height + 15}" text-anchor="middle">{t:.4g}</text>')
+    lines.append(f'<text x="{left + plot_width / 2}" y="{height - 5}" text-anchor="middle">time [s]</text>')
+    lines.append(f'<text x="15" y="{top + plot_height / 2}" text-anchor="middle" transform="rotate(-90 15 {top + plot_height / 2})">{unit}</text>')
+    lines.append(f'<rect x="{left}" y="{top}" width="{plot_width}" height="{plot_height}" fill="none" stroke="black"/>')
+    for i, (name, values) in enumerate(series.items()):
+        color = colors[i % len(colors)]
+        points = ' '.join(f'{x(t):.1f},{y(v):.1f}' for t, v in zip(times, values))
+        lines.append(f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="1.5"/>')
+        lines.append(f'<line x1="{left + plot_width + 10}" y1="{top + 10 + i * 18}" x2="{left + plot_width + 30}" y2="{top + 10 + i * 18}" stroke="{color}" stroke-width="3"/>')
+        lines.append(f'<text x="{left + plot_width + 35}" y="{top + 14 + i * 18}">{name}</text>')
+    lines.append('</svg>')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines))
+
+def render_plots(name, samples):
+    times = [sample['time'] for sample in samples]
+    cpu_count = os.cpu_count()
+    render_svg(f'plot_{name}_cpu.svg', f'{name}: CPU use of {cpu_count} CPUs', times,
+               {'busy CPUs': [sample['cpu'] * cpu_count for sample in samples]}, 'CPUs', cpu_count)
+    render_svg(f'plot_{name}_memory.svg', f'{name}: memory use', times,
+               {'used': [sample['memory'] / 1024 ** 3 for sample in samples]}, 'GB', get_total_memory() / 1024 ** 3)
+    render_svg(f'plot_{name}_processes.svg', f'{name}: live processes', times,
+               {process: [sample['processes'][process] for sample in samples] for process in process_names}, 'processes')
+    if len(pool_sizes) > 0:
+        render_svg(f'plot_{name}_workers.svg', f'{name}: busy workers', times,
+                   {f'{pool} (of {size})': [sample['workers'][pool] for sample in samples] for pool, size in pool_sizes.items()}, 'workers',
+                   max(pool_sizes.values()))
+
+def sample_load(name, stop_event):
+    samples = []
+    start = time.monotonic()
+    total, idle = get_cpu_times()
+    while not stop_event.wait(interval):
+        new_total, new_idle = get_cpu_times()
+        samples.append({
+            'time': time.monotonic() - start,
+            'cpu': 1 - (new_idle - idle) / max(new_total - total, 1),
+            'memory': get_used_memory(),
+            'processes': count_processes(),
+            'workers': {pool: busy.value for pool, busy in busy_workers.items()},
+        })
+        total, idle = new_total, new_idle
+    if len(samples) > 0:
+        render_plots(name, samples)
+
+def start(name, pools={}):
+    # pools maps the name of every worker pool of the job to its size
+    global sampler_process, stop_event
+    if interval <= 0:
+        return
+    for pool, size in pools.items():
+        busy_workers[pool] = multiprocessing.Value('i', 0)
+        pool_sizes[pool] = size
+    stop_event = multiprocessing.Event()
+    sampler_process = multiprocessing.Process(target=sample_load, args=(name, stop_event))
+    sampler_process.start()
+
+def stop():
+    if sampler_process is None:
+        return
+    stop_event.set()
+    sampler_process.join()
+
+@contextlib.contextmanager
+def busy(pool):
+    # marks a worker of the pool as busy for the plots
+    if pool not in busy_workers:
+        yield
+        return
+    with busy_workers[pool].get_lock():
+        busy_workers[pool].value += 1
+    try:
+        yield
+    finally:
+        with busy_workers[pool].get_lock():
+            busy_workers[pool].value -= 1
@@ -2,16 +2,27 @@
 
 import jinja2
 import json
+import math
+import multiprocessing
 import os
 import re
+import sampler
 import shutil
 import signal
+import socket
 import subprocess
 import sys
 import time
 import zipfile
+import cache
+import checkpoint
+import history
+import tracing
+import transfer
 from argparse import Namespace
+from xml.etree import ElementTree
 from dts2repl import dts2repl
+from joblib import Parallel, delayed, parallel_backend
 
 from colorama import init
 init()
@@ -28,12 +39,57 @@ def green(text):
     return Fore.GREEN + (text or '') + Style.RESET_ALL
 
 zephyr_path = 'zephyrproject/zephyr'
+sim_jobs = int(os.getenv('SIM_JOBS', os.getenv('NUMBER_OF_THREADS', 1)))
+# number of boards simulated by a single, long-lived Renode instance
+batch_size = int(os.getenv('RENODE_BATCH_SIZE', 1))
+work_dir = None
+renode_version = None
+dts2repl_version = None
+dts2repl_cache = cache.open_store(os.getenv('DTS2REPL_CACHE'))
+# renode-test gets at most sim_timeout seconds per board; boards which passed
+# before get their previous time multiplied by the margin, but at least sim_timeout_min
+sim_timeout = int(os.getenv('SIM_TIMEOUT', 30))
+sim_timeout_min = int(os.getenv('SIM_TIMEOUT_MIN', 10))
+sim_timeout_margin = float(os.getenv('SIM_TIMEOUT_MARGIN', 2))
+# how long Robot waits for each line on the UART, at most
+uart_timeouts = {
+    'hello_world': 5,
+    'shell_module': 5,
+    'philosophers': 5,
+    'micropython': 15,
+    'tensorflow_lite_micro': 15,
+}
+# Renode and Zephyr messages after which the sample won't recover, the run is aborted
+cpu_fault_pattern = re.compile(os.getenv('SIM_ABORT_PATTERN', r"CPU abort|[Uu]nhandled exception|CPU halted|ZEPHYR FATAL ERROR|\*\*\*\*\* .*FAULT \*\*\*\*\*"))
+# pass times of the boards from the previous runs, see history.py
+sim_history = {}
+# the boards are split between SHARD_COUNT jobs, this one simulates shard SHARD_INDEX
+shard_index = int(os.getenv('SHARD_INDEX', 0))
+shard_count = int(os.getenv('SHARD_COUNT', 1))
+# zip archives are packed by a pool of background workers
+zip_jobs = int(os.getenv('ZIP_JOBS', max(1, sim_jobs // 4)))
+zip_queue = None
+zip_compressions = {
+    'stored':   zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+    'bzip2':    zipfile.ZIP_BZIP2,
+    'lzma':     zipfile.ZIP_LZMA,
+}
+zip_level = int(os.getenv('ZIP_LEVEL')) if os.getenv('ZIP_LEVEL') else None
+# remote the build artifacts are fetched from, see transfer.py
+artifact_remote = os.getenv('ARTIFACT_REMOTE')
+# board metadata index written by build.py
+board_index = {}
+# simulation results are cached by their inputs if SIM_CACHE points to a store
+sim_cache = cache.open_store(os.getenv('SIM_CACHE'), int(os.getenv('SIM_CACHE_SIZE', 4096)) * 1024 * 1024)
 artifacts_dict = {
     'asciinema':    'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-asciinema',
+    'build-info':   'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-build.json',
     'config':       'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-config',
     'dts':          'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}.dts',
     'elf':          'artifacts/{board_name}-{sample_name}/{board_name}-zephyr-{sample_name}.elf',
     'log':          'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}.html',
+    'manifest':     'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-manifest.json',
     'monitor':      'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}_monitor.txt',
     'profiling':    'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-profile',
     'repl':         'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}.repl',
@@ -47,9 +103,10 @@ artifacts_dict = {
     'zip-sbom':     'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-sbom.zip',
     'zephyr-log':   'artifacts/{board_name}-{sample_name}/{board_name}-{sample_name}-zephyr.log',
 }
+# artifacts produced by the Renode run itself
+renode_artifacts = ('asciinema', 'log', 'monitor', 'profiling', 'save')
 
-def get_cpu_name(arch, dts_filename, verbose=False):
-    cpu_dep_chain = dts2repl.get_cpu_dep_chain(arch, dts_filename, zephyr_path, [])
+def get_cpu_name(cpu_dep_chain, verbose=False):
     verbose = os.getenv("VERBOSE", False) or verbose
     cpu_dep_chain_string = ''
     if not verbose:
@@ -63,6 +120,41 @@ def get_cpu_name(arch, dts_filename, verbose=False):
 
     return cpu_dep_chain_string
 
+def get_dts2repl_version():
+    # the installed module itself, so that a dts2repl update invalidates the cache
+    global dts2repl_version
+    if dts2repl_version is None:
+        dts2repl_version = cache.hash_file(dts2repl.__file__)
+    return dts2repl_version
+
+def get_dts_info(board, sample_name, dts_path, generate_repl):
+    # everything simulate.py needs from the board DTS, looked up once per board
+    # and stored by the hash of the DTS files, as it's the same for every sample
+    format_args = {'board_name': board['name'], 'sample_name': sample_name}
+    dts_filename = artifacts_dict['dts'].format(**format_args)
+    key = None
+    if dts2repl_cache is not None and generate_repl and os.path.exists(dts_path) and os.path.exists(dts_filename):
+        with open(dts_path, 'rb') as f:
+            source_dts = f.read()
+        dts_hash = get_artifact_hash('dts', format_args)
+        key = cache.hash_data(get_dts2repl_version(), board['name'], board['arch'], source_dts, dts_hash)
+        info = dts2repl_cache.get(key)
+        if info is not None:
+            return info
+
+    info = {
+        'cpu_dep_chain': dts2repl.get_cpu_dep_chain(board['arch'], dts_path, zephyr_path, []),
+        'uart': dts2repl.get_uart(dts_filename),
+        'repl': None,
+    }
+    if generate_repl and info['uart'] is not None:
+        fake_args = Namespace(filename=dts_filename, overlays=",".join(info['cpu_dep_chain'] + [board['name']]))
+        with tracing.span('dts2repl', board=board['name'], sample=sample_name):
+            info['repl'] = dts2repl.generate(fake_args)
+
+    if key is not None:
+        dts2repl_cache.put(key, info)
+    return info
 
 templateLoader = jinja2.FileSystemLoader(searchpath="./")
 templateEnv = jinja2.Environment(loader=templateLoader)
@@ -82,8 +174,29 @@ robot_templates = {
     'tensorflow_lite_micro': robot_template_tflm,
 }
 
-def run_in_renode(renode_platform, zephyr_platform, sample_name, uart_name, script=None):
-    rm_files = ('log.html', 'logs', 'monitor.txt')
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def get_work_dir():
+    # every worker process gets its own scratch directory, so that parallel
+    # Renode instances do not overwrite each other's logs and snapshots
+    global work_dir
+    if work_dir is None:
+        work_dir = os.path.realpath(f'renode_work/worker-{os.getpid()}')
+        os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+def clean_work_dir(path):
+    for f in os.listdir(path):
+        f = os.path.join(path, f)
+        if os.path.isdir(f):
+            shutil.rmtree(f)
+        else:
+            os.remove(f)
+
+def render_renode_files(renode_platform, zephyr_platform, sample_name, uart_name, monitor_path, script=None, uart_timeout=None):
     format_args = {
         'board_name': zephyr_platform,
         'sample_name': sample_name,
@@ -91,10 +204,7 @@ def run_in_renode(renode_platform, zephyr_platform, sample_name, uart_name, scri
     resc_filename = artifacts_dict['resc'].format(**format_args)
     repl_filename = artifacts_dict['repl'].format(**format_args)
     robot_filename = artifacts_dict['robot'].format(**format_args)
-    monitor_filename = artifacts_dict['monitor'].format(**format_args)
-    log_filename = artifacts_dict['log'].format(**format_args)
     config_filename = artifacts_dict['config'].format(**format_args)
-    save_filename = artifacts_dict['save'].format(**format_args)
 
     if os.path.exists(f"renode_portable/platforms/{renode_platform}"):
         shutil.copy2(f"renode_portable/platforms/{renode_platform}", repl_filename)
@@ -108,6 +218,7 @@ def run_in_renode(renode_platform, zephyr_platform, sample_name, uart_name, scri
             path_to_artifacts="artifacts",
             sample_name=sample_name,
             uart_name=uart_name,
+            monitor_path=monitor_path,
             script=script
         ))
 
@@ -121,28 +232,74 @@ def run_in_renode(renode_platform, zephyr_platform, sample_name, uart_name, scri
             board_name=zephyr_platform,
             config_board_name=config_board_name,
             uart_name=uart_name,
-            sample_name=sample_name
+            sample_name=sample_name,
+            uart_timeout=uart_timeout or uart_timeouts[sample_name]
         ))
 
-    try:
-        process = subprocess.Popen(f"./renode_portable/renode-test --kill-stale-renode-instances {artifacts_dict['robot'].format(board_name=zephyr_platform, sample_name=sample_name)}".split(), start_new_session=True)
-        pgid = os.getpgid(process.pid)
-        _, __ = process.communicate(timeout=30)
-        ret = process.returncode
-    except subprocess.TimeoutExpired:
-        # We send two interrupt signals to shut down Robot
-        print(f"Timeout running tests for {zephyr_platform}-{sample_name}")
-        os.killpg(pgid, signal.SIGINT)
-        os.killpg(pgid, signal.SIGINT)
-        process.terminate()
-        ret = 1
-
-    snapshot_path = os.path.join("snapshots", os.path.basename(save_filename))
+    return robot_filename
+
+def find_cpu_fault(monitor_path, position):
+    # look for a fault in the part of the monitor log written since position
+    if monitor_path is None or not os.path.exists(monitor_path):
+        return None, position
+    with open(monitor_path, 'rb') as f:
+        f.seek(position)
+        new_output = f.read()
+    # only complete lines, the rest is checked the next time
+    new_output = new_output[:new_output.rfind(b'\n') + 1]
+    for line in new_output.decode(errors='replace').splitlines():
+        if cpu_fault_pattern.search(line):
+            return line.strip(), position + len(new_output)
+    return None, position + len(new_output)
+
+def stop_renode_test(process):
+    # We send two interrupt signals to shut down Robot
+    pgid = os.getpgid(process.pid)
+    os.killpg(pgid, signal.SIGINT)
+    os.killpg(pgid, signal.SIGINT)
+    process.terminate()
+
+def start_renode_test(robot_filenames, work_dir, timeout, name, monitor_path=None):
+    # returns the exit code and why the tests were stopped, None if they weren't
+    # stale instances can only be killed safely when there are no other workers
+    renode_args = f"--results-dir {work_dir} --port {get_free_port()}"
+    if sim_jobs == 1:
+        renode_args += " --kill-stale-renode-instances"
+
+    process = subprocess.Popen(f"./renode_portable/renode-test {renode_args} {' '.join(robot_filenames)}".split(), start_new_session=True)
+    deadline = time.monotonic() + timeout
+    position = 0
+    while True:
+        try:
+            process.wait(timeout=0.5)
+            return process.returncode, None
+        except subprocess.TimeoutExpired:
+            pass
+        fault, position = find_cpu_fault(monitor_path, position)
+        if fault is not None:
+            print(f"Aborting tests for {name}: {fault}")
+            stop_renode_test(process)
+            return 1, 'abort'
+        if time.monotonic() > deadline:
+            print(f"Timeout running tests for {name}")
+            stop_renode_test(process)
+            return 1, 'timeout'
+
+def save_renode_artifacts(zephyr_platform, sample_name, work_dir, monitor_path, robot_log_path):
+    format_args = {
+        'board_name': zephyr_platform,
+        'sample_name': sample_name,
+    }
+    monitor_filename = artifacts_dict['monitor'].format(**format_args)
+    log_filename = artifacts_dict['log'].format(**format_args)
+    save_filename = artifacts_dict['save'].format(**format_args)
+
+    snapshot_path = os.path.join(work_dir, "snapshots", os.path.basename(save_filename))
     if os.path.exists(snapshot_path):
         shutil.copy2(snapshot_path, save_filename)
 
-    if os.path.exists("monitor.txt"):
-        with open("monitor.txt") as f:
+    if os.path.exists(monitor_path):
+        with open(monitor_path) as f:
             monitor = f.read().split('\n')
 
         # save only the first 100 lines of logs
@@ -151,25 +308,113 @@ def run_in_renode(renode_platform, zephyr_platform, sample_name, uart_name, scri
             f.write(monitor)
 
     # give Renode 1s of time if Robot logs were not yet generated
-    if not os.path.exists("log.html"):
+    if not os.path.exists(robot_log_path):
         time.sleep(1)
-    if os.path.exists("log.html"):
-        shutil.copy2("log.html", log_filename);
+    if os.path.exists(robot_log_path):
+        shutil.copy2(robot_log_path, log_filename);
 
-    # clean unneeded artifacts
-    for f in rm_files:
-        if os.path.exists(f):
-            if os.path.isdir(f):
-                shutil.rmtree(f)
-            else:
-                os.remove(f)
-
-    if ret:
-        print(red("Test failed."))
-        return False
-    else:
+def print_test_status(passed):
+    if passed:
         print(green("Test passed."))
-        return True
+    else:
+        print(red("Test failed."))
+
+def run_in_renode(test):
+    zephyr_platform = test['zephyr_platform']
+    sample_name = test['sample_name']
+    work_dir = get_work_dir()
+    start = time.monotonic()
+    trace_start = tracing.now()
+    ret, test['stopped'] = start_renode_test([test['robot_filename']], work_dir, test['timeout'], f"{zephyr_platform}-{sample_name}", test['monitor_path'])
+    trace_end = tracing.now()
+    test['times'] = {'process': round(time.monotonic() - start, 2)}
+    test_results = get_robot_test_results(os.path.join(work_dir, "robot_output.xml"))
+    if f"{sample_name} on {zephyr_platform}" in test_results:
+        test['times']['test'] = test_results[f"{sample_name} on {zephyr_platform}"]['time']
+    trace_renode_test(trace_start, trace_end, test)
+    with tracing.span('save renode artifacts', board=zephyr_platform, sample=sample_name):
+        save_renode_artifacts(zephyr_platform, sample_name, work_dir, test['monitor_path'], os.path.join(work_dir, "log.html"))
+
+    # clean unneeded artifacts
+    clean_work_dir(work_dir)
+
+    print_test_status(not ret)
+    return not ret
+
+def trace_renode_test(start, end, test):
+    # the robot run is the part of the renode-test process Robot accounts for,
+    # the rest is mostly starting Renode and Robot
+    args = {'board': test['zephyr_platform'], 'sample': test['sample_name']}
+    tracing.add_span('renode-test', start, end, **args)
+    test_time = test['times'].get('test')
+    if test_time is not None and test_time <= end - start:
+        tracing.add_span('renode startup', start, end - test_time, **args)
+        tracing.add_span('robot run', end - test_time, end, **args)
+
+def get_robot_elapsed_time(status):
+    if status.get('elapsed') is not None:
+        return float(status.get('elapsed'))
+    # Robot Framework before 7.0
+    try:
+        start = time.strptime(status.get('starttime')[:17], '%Y%m%d %H:%M:%S')
+        end = time.strptime(status.get('endtime')[:17], '%Y%m%d %H:%M:%S')
+        return time.mktime(end) - time.mktime(start) + (float(status.get('endtime')[17:] or 0) - float(status.get('starttime')[17:] or 0))
+    except (TypeError, ValueError):
+        return None
+
+def get_robot_test_results(output_filename):
+    results = {}
+    if os.path.exists(output_filename):
+        try:
+            for test in ElementTree.parse(output_filename).iter('test'):
+                status = test.find('status')
+                results[test.get('name')] = {
+                    'passed': status is not None and status.get('status') == 'PASS',
+                    'time': get_robot_elapsed_time(status) if status is not None else None,
+                }
+        except ElementTree.ParseError:
+            print(f"Could not parse {output_filename}")
+    return results
+
+def run_in_renode_batch(tests):
+    # run all tests from the batch in a single renode-test invocation, which
+    # keeps one Renode instance alive and resets the emulation between suites
+    if len(tests) == 0:
+        return {}
+
+    work_dir = get_work_dir()
+    robot_filenames = [test['robot_filename'] for test in tests]
+
+    names = ", ".join(test['zephyr_platform'] for test in tests)
+    with tracing.span('renode-test', board=names, sample=tests[0]['sample_name']):
+        _, stopped = start_renode_test(robot_filenames, work_dir, sum(test['timeout'] for test in tests), names)
+    test_results = get_robot_test_results(os.path.join(work_dir, "robot_output.xml"))
+
+    passed = {}
+    for test in tests:
+        zephyr_platform = test['zephyr_platform']
+        sample_name = test['sample_name']
+        test_name = f"{sample_name} on {zephyr_platform}"
+
+        # split the merged Robot output into a per-board log
+        robot_log_path = os.path.join(work_dir, f"{zephyr_platform}-{sample_name}.html")
+        subprocess.run([sys.executable, "-m", "robot.rebot", "--test", test_name, "--log", robot_log_path,
+                        "--report", "NONE", "--output", "NONE", os.path.join(work_dir, "robot_output.xml")],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        save_renode_artifacts(zephyr_platform, sample_name, work_dir, test['monitor_path'], robot_log_path)
+
+        passed[zephyr_platform] = test_name in test_results and test_results[test_name]['passed']
+        if not passed[zephyr_platform]:
+            test['stopped'] = stopped
+        if test_name in test_results:
+            test['times'] = {'test': test_results[test_name]['time']}
+        print(f"{bold(zephyr_platform)}: ", end='')
+        print_test_status(passed[zephyr_platform])
+
+    # clean unneeded artifacts
+    clean_work_dir(work_dir)
+
+    return passed
 
 def conv_zephyr_mem_usage(val):
     if val.endswith(' B'):
@@ -188,22 +433,84 @@ def find_flash_size(dts_filename):
     with open(dts_filename) as f:
         dts = f.read()
     flash_name = re.search(r"zephyr,flash = &(\w+);", dts).group(1)
-    flash_size = re.search(r"{}:(.*\n)*?.*reg = <(.*)>;".format(flash_name), dts).group(2)
+    # first reg property after the flash node label
+    flash_size = re.compile(r"reg = <(.*)>;").search(dts, dts.index(f"{flash_name}:")).group(1)
     flash_size = flash_size.split()
 
     return flash_name, flash_size
 
+def get_zip_compression():
+    compression = zip_compressions.get(os.getenv('ZIP_COMPRESSION', 'deflated'))
+    if compression is None:
+        print(f"Unsupported zip compression {os.getenv('ZIP_COMPRESSION')}, using deflated")
+        compression = zipfile.ZIP_DEFLATED
+    return compression
+
 def create_zip_archive(platform, zip_name=None, files=[]):
     if zip_name is None:
         zip_filename = artifacts_dict['zip'].format(**platform)
     else:
         zip_filename = zip_name
 
-    with zipfile.ZipFile(zip_filename, 'w') as f:
-        for ftype in platform['files'] if files == [] else files:
-            fname = artifacts_dict[ftype].format(**platform)
-            if os.path.exists(fname):
-                f.write(fname)
+    with tracing.span('zip', board=platform['board_name'], sample=platform['sample_name']):
+        # written next to it and moved into place when complete, so that an
+        # interrupted run leaves no truncated archive behind
+        with zipfile.ZipFile(zip_filename + '.tmp', 'w', compression=get_zip_compression(), compresslevel=zip_level) as f:
+            for ftype in platform['files'] if files == [] else files:
+                fname = artifacts_dict[ftype].format(**platform)
+                if os.path.exists(fname):
+                    f.write(fname)
+        os.replace(zip_filename + '.tmp', zip_filename)
+
+def zip_worker(queue):
+    # packing is not on the critical path, let the simulations have the CPU first
+    os.nice(10)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        # a board whose archive can't be packed must not take the worker down
+        # with the archives of the boards after it
+        try:
+            create_zip_archive(*item)
+        except Exception as e:
+            platform, zip_name, _ = item
+            print(red(f"Could not pack {zip_name or artifacts_dict['zip'].format(**platform)} of {platform['board_name']}: {e!r}"))
+
+def start_zip_workers(zip_jobs):
+    global zip_queue
+    zip_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=zip_worker, args=(zip_queue,)) for _ in range(zip_jobs)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def stop_zip_workers(workers):
+    for _ in workers:
+        zip_queue.put(None)
+    failed = False
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            print(red(f"Zip worker {worker.pid} exited with {worker.exitcode}, some archives may be missing"))
+            failed = True
+    if failed:
+        # nobody reads what is left in the queue, which must not hold up the exit
+        zip_queue.cancel_join_thread()
+
+def queue_zip_archive(platform, zip_name=None, files=[]):
+    # the archives are packed in the background when the zip workers are running
+    if zip_queue is None:
+        create_zip_archive(platform, zip_name, files)
+    else:
+        zip_queue.put((platform, zip_name, files))
+
+def queue_missing_zip_archives(results):
+    # archives of an interrupted run might not have been packed yet
+    for result in results:
+        if not os.path.exists(artifacts_dict['zip'].format(**result)) or not os.path.exists(artifacts_dict['zip-sbom'].format(**result)):
+            queue_zip_archive(result)
+            queue_zip_archive(result, zip_name=artifacts_dict['zip-sbom'].format(**result), files=['sbom-app', 'sbom-zephyr', 'sbom-build'])
 
 def get_artifacts_list(platform):
     ret = []
@@ -214,7 +521,37 @@ def get_artifacts_list(platform):
 
     return ret
 
-def run_renode_simulation(board, sample_name):
+def get_pass_times(board_name):
+    # a board which didn't pass recently gets the full timeouts
+    return sim_history.get(board_name, {}).get('sim_time')
+
+def get_timeouts(board_name, sample_name):
+    # renode-test and UART timeouts from the previous pass times of the board
+    timeout = sim_timeout
+    uart_timeout = uart_timeouts[sample_name]
+    pass_times = get_pass_times(board_name)
+    if pass_times is not None:
+        if pass_times.get('process') is not None:
+            timeout = min(sim_timeout, max(sim_timeout_min, math.ceil(pass_times['process'] * sim_timeout_margin)))
+        if pass_times.get('test') is not None:
+            uart_timeout = min(uart_timeout, max(1, math.ceil(pass_times['test'] * sim_timeout_margin)))
+    return timeout, uart_timeout
+
+def update_sim_history(sim_history, results):
+    # remember how long the passing boards took; cached results weren't timed
+    new_history = dict(sim_history)
+    for result in results:
+        entry = dict(new_history.get(result['board_name'], {}))
+        if 'sim_time' in result:
+            entry['sim_time'] = result['sim_time']
+        elif result['status'] != 'PASSED':
+            entry.pop('sim_time', None)
+        if 'sim_duration' in result and result.get('cache') != 'HIT':
+            entry['sim_duration'] = result['sim_duration']
+        new_history[result['board_name']] = entry
+    return new_history
+
+def prepare_renode_simulation(board, sample_name):
     result = {
         'board_name': board['name'],
         'board_path': board['path'],
@@ -225,22 +562,30 @@ def run_renode_simulation(board, sample_name):
     elf_filename = artifacts_dict['elf'].format(**result)
     dts_filename = artifacts_dict['dts'].format(**result)
     repl_filename = artifacts_dict['repl'].format(**result)
-    save_filename = artifacts_dict['save'].format(**result)
-    zephyr_log_filename = artifacts_dict['zephyr-log'].format(**result)
 
     if os.path.exists(elf_filename):
         result['status'] = 'BUILT'
 
-    uart = try_match_board(board)
-
     result['arch'] = board['arch']
     result['board_full_name'] = board['full_name']
-
-    dts_path = f'{zephyr_path}/{result["board_path"]}/{result["board_name"]}.dts'
-    result['cpu'] = get_cpu_name(result['arch'], dts_path)
-    cpu_dep_chain = dts2repl.get_cpu_dep_chain(result['arch'], dts_path, zephyr_path, [])
+    if 'skipped' in board:
+        # the build stage found the board can't be simulated and didn't build it
+        result['skipped'] = board['skipped']
+    if 'build_status' in board:
+        result['build_status'] = board['build_status']
+    if 'build_duration' in board:
+        result['build_duration'] = board['build_duration']
+
+    if board_index.get(board['name'], {}).get('dts') is not None:
+        dts_path = f"{zephyr_path}/{board_index[board['name']]['dts']}"
+    else:
+        dts_path = f'{zephyr_path}/{result["board_path"]}/{result["board_name"]}.dts'
+    dts_info = get_dts_info(board, sample_name, dts_path, result['status'] != 'NOT BUILT')
+    uart = dts_info['uart']
+    result['cpu'] = get_cpu_name(dts_info['cpu_dep_chain'])
 
     extra_cmd = None
+    test = None
 
     if uart is None:
         print("No uart. Cannot run test.")
@@ -248,11 +593,8 @@ def run_renode_simulation(board, sample_name):
         result['uart_name'] = uart
 
     if uart is not None and result['status'] != 'NOT BUILT':
-        passed = False
-
         print(f"Autogenerating repl for {bold(board['name'])} using device tree.")
-        fake_args = Namespace(filename=dts_filename, overlays=",".join(cpu_dep_chain + [board['name']]))
-        repl = dts2repl.generate(fake_args)
+        repl = dts_info['repl']
         with open(repl_filename, 'w') as repl_file:
             repl_file.write(repl)
 
@@ -261,9 +603,27 @@ def run_renode_simulation(board, sample_name):
         elif "RiscV" in repl:
             extra_cmd = f"cpu0 EnableProfiler true $ORIGIN/{board['name']}-{sample_name}-profile true"
 
-        passed = run_in_renode(repl_filename, board['name'], sample_name, uart, extra_cmd)
+        monitor_path = os.path.join(get_work_dir(), f"{board['name']}-{sample_name}-monitor.txt")
+        timeout, uart_timeout = get_timeouts(board['name'], sample_name)
+        test = {
+            'zephyr_platform': board['name'],
+            'sample_name': sample_name,
+            'robot_filename': render_renode_files(repl_filename, board['name'], sample_name, uart, monitor_path, extra_cmd, uart_timeout),
+            'monitor_path': monitor_path,
+            'timeout': timeout,
+            'uart_timeout': uart_timeout,
+        }
+
+    return result, test
+
+def finish_renode_simulation(result, passed):
+    dts_filename = artifacts_dict['dts'].format(**result)
+    save_filename = artifacts_dict['save'].format(**result)
+    zephyr_log_filename = artifacts_dict['zephyr-log'].format(**result)
+
+    if passed is not None:
         result['repl_type'] = 'AUTO'
-        result['repl_name'] = f"{board['name']}-{sample_name}.repl"
+        result['repl_name'] = f"{result['board_name']}-{result['sample_name']}.repl"
         if passed:
             # state snapshot was created by the previously failed run (dict-matched)
             if os.path.exists(save_filename):
@@ -272,26 +632,40 @@ def run_renode_simulation(board, sample_name):
 
     # create zip archive with all artifacts
     result['files'] = get_artifacts_list(result)
-    create_zip_archive(result)
+    queue_zip_archive(dict(result))
 
     # create zip archive with sboms
     sbom_zip_name = artifacts_dict['zip-sbom'].format(**result)
-    create_zip_archive(result, zip_name=sbom_zip_name, files=['sbom-app', 'sbom-zephyr', 'sbom-build'])
+    queue_zip_archive(dict(result), zip_name=sbom_zip_name, files=['sbom-app', 'sbom-zephyr', 'sbom-build'])
 
     # get memory usage
     memory = {}
     if result['status'] != 'NOT BUILT':
-        with open(zephyr_log_filename) as f:
-            match = re.findall(r"(?P<region>\w+){1}:\s*(?P<used>\d+\s+\w{1,2})\s*(?P<size>\d+\s+\w{1,2})\s*(?P<percentage>\d+.\d+%)", f.read())
-        for m in match:
-            region, used, size, _ = m
-            memory[region] = {
-                'used': conv_zephyr_mem_usage(used),
-                'size': conv_zephyr_mem_usage(size),
-            }
+        build_info_filename = artifacts_dict['build-info'].format(**result)
+        build_info = {}
+        if os.path.exists(build_info_filename):
+            with open(build_info_filename) as f:
+                build_info = json.load(f)
+
+        if 'memory' in build_info:
+            memory = build_info['memory']
+        else:
+            # artifacts built before the build stage wrote its facts down
+            with open(zephyr_log_filename) as f:
+                match = re.findall(r"(?P<region>\w+){1}:\s*(?P<used>\d+\s+\w{1,2})\s*(?P<size>\d+\s+\w{1,2})\s*(?P<percentage>\d+.\d+%)", f.read())
+            for m in match:
+                region, used, size, _ = m
+                memory[region] = {
+                    'used': conv_zephyr_mem_usage(used),
+                    'size': conv_zephyr_mem_usage(size),
+                }
 
         # check if flash size was increased
-        if os.path.exists(dts_filename + '.orig') and 'FLASH' in memory:
+        if 'flash' in build_info and 'FLASH' in memory:
+            memory['FLASH'].update({
+                'size': build_info['flash']['flash_size'],
+            })
+        elif os.path.exists(dts_filename + '.orig') and 'FLASH' in memory:
             _, flash_size = find_flash_size(dts_filename + '.orig')
             flash_size = int(flash_size[-1], 16)
             memory['FLASH'].update({
@@ -302,11 +676,110 @@ def run_renode_simulation(board, sample_name):
 
     return result
 
-def try_match_board(board):
-    sample_name, _ = get_sample_name_path()
-    dts_filename = artifacts_dict['dts'].format(board_name=board['name'], sample_name=sample_name)
-    uart = dts2repl.get_uart(dts_filename)
-    return uart
+def get_artifact_hash(ftype, format_args):
+    # build artifacts are hashed once by build.py and listed in the board manifest
+    filename = artifacts_dict[ftype].format(**format_args)
+    manifest_filename = artifacts_dict['manifest'].format(**format_args)
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            entry = json.load(f).get(os.path.basename(filename))
+        if entry is not None and entry['size'] == os.path.getsize(filename):
+            return entry['hash']
+    return cache.hash_file(filename)
+
+def get_simulation_cache_key(test):
+    format_args = {
+        'board_name': test['zephyr_platform'],
+        'sample_name': test['sample_name'],
+    }
+    contents = [get_artifact_hash('elf', format_args)]
+    for ftype in ('repl', 'robot', 'resc'):
+        with open(artifacts_dict[ftype].format(**format_args), 'rb') as f:
+            contents.append(f.read())
+
+    # the monitor log lives in the per-worker scratch directory, which must not affect the key
+    contents[-1] = contents[-1].replace(os.path.dirname(test['monitor_path']).encode(), b'')
+    # neither do the timeouts, which follow the previous runs
+    contents[-2] = re.sub(rb'timeout=\d+', b'', contents[-2])
+    return cache.hash_data(renode_version or '', *contents)
+
+def get_cached_simulation(test):
+    # returns the stored test status and restores the artifacts generated by Renode
+    entry = sim_cache.get(test['cache_key'])
+    if entry is None:
+        return None
+
+    format_args = {
+        'board_name': test['zephyr_platform'],
+        'sample_name': test['sample_name'],
+    }
+    for ftype in entry['files']:
+        sim_cache.get_file(test['cache_key'], ftype, artifacts_dict[ftype].format(**format_args))
+    print(f"{bold(test['zephyr_platform'])}: using cached simulation result")
+    return entry['passed']
+
+def store_simulation(test, passed):
+    format_args = {
+        'board_name': test['zephyr_platform'],
+        'sample_name': test['sample_name'],
+    }
+    files = {}
+    for ftype in renode_artifacts:
+        filename = artifacts_dict[ftype].format(**format_args)
+        if os.path.exists(filename):
+            files[ftype] = filename
+    sim_cache.put(test['cache_key'], {'passed': passed, 'files': list(files)}, files)
+
+def is_cacheable(test, passed):
+    # the timeouts are left out of the cache key, so a failure is only kept
+    # when renode-test finished on its own with the full timeouts
+    if passed:
+        return True
+    return test.get('stopped') is None and test['timeout'] >= sim_timeout and test['uart_timeout'] >= uart_timeouts[test['sample_name']]
+
+def run_cached(tests, run):
+    # run only the tests that are not in the simulation cache
+    passed = {}
+    to_run = []
+    for test in tests:
+        if sim_cache is not None:
+            test['cache_key'] = get_simulation_cache_key(test)
+            cached = get_cached_simulation(test)
+            if cached is not None:
+                test['cache'] = 'HIT'
+                passed[test['zephyr_platform']] = cached
+                continue
+            test['cache'] = 'MISS'
+        to_run.append(test)
+
+    passed.update(run(to_run))
+    if sim_cache is not None:
+        for test in to_run:
+            if is_cacheable(test, passed[test['zephyr_platform']]):
+                store_simulation(test, passed[test['zephyr_platform']])
+    return passed
+
+def run_renode_simulation(board, sample_name):
+    result, test = prepare_renode_simulation(board, sample_name)
+    passed = None
+    if test is not None:
+        passed = run_cached([test], lambda tests: {t['zephyr_platform']: run_in_renode(t) for t in tests})
+        passed = passed[test['zephyr_platform']]
+        if 'cache' in test:
+            result['cache'] = test['cache']
+        if passed and 'times' in test:
+            result['sim_time'] = test['times']
+    return finish_renode_simulation(result, passed)
+
+def run_renode_simulation_batch(boards, sample_name):
+    prepared = [prepare_renode_simulation(board, sample_name) for board in boards]
+    passed = run_cached([test for _, test in prepared if test is not None], run_in_renode_batch)
+    for result, test in prepared:
+        if test is not None and 'cache' in test:
+            result['cache'] = test['cache']
+        if test is not None and passed.get(result['board_name']) and 'times' in test:
+            result['sim_time'] = test['times']
+    return [finish_renode_simulation(result, passed.get(result['board_name']) if test is not None else None) for result, test in prepared]
 
 samples = (
     # sample name and path of the samples that we support
@@ -329,11 +802,33 @@ def loop_wrapper(b, i, total_boards, sample_name):
         print(f">> [{i} / {total_boards}] -- {board_name} --")
     out = None
 
-    out = run_renode_simulation(b, sample_name)
+    start = time.monotonic()
+    with sampler.busy('simulate'):
+        out = run_renode_simulation(b, sample_name)
+    out['sim_duration'] = round(time.monotonic() - start, 2)
+    checkpoint.append(f'results-{sample_name}', out)
     if total_boards > 1:
         print(f"<< [{i} / {total_boards}] -- {board_name} --")
     return out
 
+def batch_loop_wrapper(batch, i, total_boards, sample_name):
+    # i is the index of the first board in the batch
+    last = i + len(batch) - 1
+    if total_boards > 1:
+        print(f">> [{i}-{last} / {total_boards}] -- {', '.join(b['name'] for b in batch)} --")
+
+    start = time.monotonic()
+    with sampler.busy('simulate'):
+        out = run_renode_simulation_batch(batch, sample_name)
+    # the boards of a batch share one renode-test run
+    for result in out:
+        result['sim_duration'] = round((time.monotonic() - start) / len(batch), 2)
+    for result in out:
+        checkpoint.append(f'results-{sample_name}', result)
+    if total_boards > 1:
+        print(f"<< [{i}-{last} / {total_boards}] --")
+    return out
+
 def get_renode_version():
     renode_ver = subprocess.run(f'./renode_portable/renode -v', capture_output=True, shell=True).stdout.decode()
     if renode_ver == "":
@@ -345,26 +840,107 @@ def get_renode_version():
 
     return renode_commit, f'renode-{renode_ver}+{renode_date}@git{renode_commit}'
 
-if __name__ == '__main__':
+def write_renode_version():
     # Get and write Renode version; save commit hash for later usage
+    global renode_version
     with open('artifacts/renode.version', 'w') as f:
         renode_ver = get_renode_version()
         if renode_ver is None:
            print('error: renode not found')
            sys.exit(1)
 
-        renode_commit = renode_ver[0]
         f.write(renode_ver[1])
 
+    renode_version = renode_ver[1]
+    return renode_ver[0]
+
+def finish_sim_cache(results, sample_name):
+    if sim_cache is None:
+        return
+    hits = sum(1 for result in results if result.get('cache') == 'HIT')
+    misses = sum(1 for result in results if result.get('cache') == 'MISS')
+    print(f"Simulation cache: {bold(str(hits))} hits, {bold(str(misses))} misses")
+    evicted = sim_cache.evict()
+    if evicted:
+        print(f"Evicted {evicted} entries from the simulation cache")
+    # saved with the results, the shards of a sample are summed up by merge_shards.py
+    os.makedirs("artifacts/results", exist_ok=True)
+    with open(f"artifacts/results/sim-cache-{sample_name}.json", "w") as f:
+        json.dump({'hits': hits, 'misses': misses, 'evicted': evicted}, f)
+
+def get_boards_in_shard(boards):
+    if shard_count == 1:
+        return boards
+    # boards built by a sharded build job stay in the shard they were built in
+    shards = history.get_shards(history.get_durations([board['name'] for board in boards if 'shard' not in board], sim_history, 'sim_duration'), shard_count)
+    boards_in_shard = [board for board in boards if board.get('shard', shards.get(board['name'])) == shard_index]
+    print(f"Shard {bold(str(shard_index + 1))} of {shard_count}: {bold(str(len(boards_in_shard)))} of {len(boards)} boards")
+    return boards_in_shard
+
+def load_results(boards, sample_name):
+    # the results of every board in its original order, from the results log
+    logged = {result['board_name']: result for result in checkpoint.load(f'results-{sample_name}')}
+    return [logged[board['name']] for board in boards if board['name'] in logged]
+
+def save_results(results, sample_name):
+    os.makedirs("artifacts/results", exist_ok=True)
+    with open(f"artifacts/results/results-{sample_name}_all.json", "w") as f:
+        json.dump(results, f)
+
+if __name__ == '__main__':
+    renode_commit = write_renode_version()
 
     sample_name, _ = get_sample_name_path()
-    with open("artifacts/built_boards.json") as file:
+    job_name = f'simulate-{sample_name}' + (f'-{shard_index}' if shard_count > 1 else '')
+    tracing.start(job_name)
+    # a build of several samples leaves one list per sample
+    built_boards_path = f"artifacts/built_boards-{sample_name}.json"
+    if not os.path.exists(built_boards_path):
+        built_boards_path = "artifacts/built_boards.json"
+    with open(built_boards_path) as file:
         boards_to_run = json.loads(file.read())
-
+    if os.path.exists("artifacts/boards.json"):
+        with open("artifacts/boards.json") as file:
+            board_index = json.load(file)
+    sim_history = history.load_history(sample_name)
+    boards_to_run = get_boards_in_shard(boards_to_run)
+
+    simulated_boards = {result['board_name']: result for result in checkpoint.start(f'results-{sample_name}')}
+    if len(simulated_boards) > 0:
+        print(f"Resuming, {bold(str(len(simulated_boards)))} boards were already simulated")
+    all_boards = boards_to_run
+    boards_to_run = [board for board in boards_to_run if board['name'] not in simulated_boards]
+    boards_by_name = {board['name']: board for board in boards_to_run}
+    boards_to_run = [boards_by_name[board_name] for board_name in history.longest_first(list(boards_by_name), sim_history, 'sim_duration')]
     total_boards = len(boards_to_run)
-    sim_jobs = int(os.getenv('SIM_JOBS', 1))
-
-    results = [loop_wrapper(b, i, total_boards, sample_name) for i, b in enumerate(boards_to_run, start=1)]
 
-    with open(f"artifacts/results/results-{sample_name}_all.json", "w") as f:
-        json.dump(results, f)
+    if artifact_remote is not None:
+        # only the artifacts of boards that were built are needed, and the DTS
+        # which confirmed a skipped board has no UART, for the next run
+        board_dirs = tuple(f"{board['name']}-{sample_name}/" for board in all_boards if 'skipped' not in board)
+        skipped_dts = set(artifacts_dict['dts'].format(board_name=board['name'], sample_name=sample_name)[len('artifacts/'):] for board in all_boards if 'skipped' in board)
+        with open("artifacts/manifest.json") as file:
+            paths = [path for path in json.load(file) if path.startswith(board_dirs) or path in skipped_dts]
+        print(f"Fetched {transfer.fetch(artifact_remote, 'artifacts', paths)} artifacts from {artifact_remote}")
+
+    zip_workers = start_zip_workers(zip_jobs)
+    queue_missing_zip_archives(simulated_boards.values())
+    sampler.start(job_name, {'simulate': sim_jobs})
+    with parallel_backend('multiprocessing', n_jobs=sim_jobs):
+        if batch_size > 1:
+            batches = [boards_to_run[i:i + batch_size] for i in range(0, total_boards, batch_size)]
+            results = Parallel()(delayed(batch_loop_wrapper)(batch, i * batch_size + 1, total_boards, sample_name) for i, batch in enumerate(batches))
+            results = [result for batch in results for result in batch]
+        else:
+            results = Parallel()(delayed(loop_wrapper)(b, i, total_boards, sample_name) for i, b in enumerate(boards_to_run, start=1))
+
+    stop_zip_workers(zip_workers)
+    sampler.stop()
+    shutil.rmtree('renode_work', ignore_errors=True)
+
+    finish_sim_cache(results, sample_name)
+    results = load_results(all_boards, sample_name)
+    save_results(results, sample_name)
+    history.save_history(update_sim_history(sim_history, results), sample_name)
+    tracing.finish()
+    transfer.write_manifest('artifacts')
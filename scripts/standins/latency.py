@@ -0,0 +1,84 @@
+import json
+import math
+import os
+import random
+import time
+
+# latency profile shared by the west and Renode stand-ins of the benchmark
+# (see benchmark.py); BENCH_PROFILE names a JSON file overriding some of the
+# defaults and BENCH_SEED makes every board behave differently, but the same
+# way in every run
+
+defaults = {
+    # times are medians in seconds, every board gets its own log-normal draw
+    # around them with the given spread (sigma)
+    'build_time': 2.0,
+    'build_time_spread': 0.5,
+    # a build in a kept build directory (BUILD_CACHE) only takes that part of the time
+    'incremental_factor': 0.3,
+    'spdx_init_time': 0.05,
+    'spdx_time': 0.3,
+    # MB held by every west build and Renode instance
+    'build_memory': 64,
+    'sim_memory': 128,
+    # median size of the firmware image in KB
+    'image_size': 24,
+    # share of the builds which fail, overflow the flash (and pass with a
+    # bigger one) or run out of memory
+    'build_fail_rate': 0.05,
+    'flash_overflow_rate': 0.05,
+    'oom_rate': 0.0,
+    'renode_startup_time': 1.0,
+    'sim_time': 1.0,
+    'sim_time_spread': 0.5,
+    # share of the simulations which fail, hit a CPU fault and then hang, or
+    # hang for sim_hang_time without any output
+    'sim_fail_rate': 0.1,
+    'sim_fault_rate': 0.02,
+    'sim_hang_rate': 0.01,
+    'sim_hang_time': 600,
+    # all times are multiplied by it, for quick runs
+    'time_scale': 1.0,
+}
+
+seed = os.getenv('BENCH_SEED', '0')
+
+def load_profile():
+    profile = dict(defaults)
+    if os.getenv('BENCH_PROFILE'):
+        with open(os.getenv('BENCH_PROFILE')) as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(defaults)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown latency profile keys: {', '.join(sorted(unknown))}")
+        profile.update(overrides)
+    return profile
+
+def get_random(*keys):
+    # a generator of its own for every board and sample, so that the result
+    # doesn't depend on the order the boards are run in
+    return random.Random(':'.join((seed,) + keys))
+
+def get_latency(profile, rng, name):
+    median = profile[name] * profile['time_scale']
+    spread = profile.get(f'{name}_spread', 0)
+    if median <= 0:
+        return 0
+    return rng.lognormvariate(math.log(median), spread) if spread > 0 else median
+
+def get_outcome(rng, rates):
+    # one of the outcomes by their rates, None for the rest
+    draw = rng.random()
+    for outcome, rate in rates:
+        if draw < rate:
+            return outcome
+        draw -= rate
+    return None
+
+def hold_memory(megabytes):
+    # written to, so that it really counts in the RSS
+    return b'\1' * int(megabytes * 1024 * 1024)
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
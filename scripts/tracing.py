@@ -0,0 +1,96 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+import checkpoint
+
+# spans of the phases of every board (west build, dts2repl, renode-test, ...)
+# recorded by all worker processes into the artifacts/trace-<name>.jsonl log
+# and turned into a Chrome trace (chrome://tracing, ui.perfetto.dev) and a
+# summary of the phases at the end of the run; TRACE=0 turns it off
+
+enabled = os.getenv('TRACE', '1') == '1'
+# set by start() before the workers are forked; the directory is absolute,
+# as the builds change into the Zephyr tree while their spans are recorded
+trace_name = None
+trace_dir = None
+
+def now():
+    return time.time()
+
+def start(name, directory='artifacts'):
+    # spans of an interrupted run are kept when resuming, like its results
+    global trace_name, trace_dir
+    trace_name = name
+    trace_dir = os.path.realpath(directory)
+    if enabled:
+        checkpoint.start(f'trace-{trace_name}', trace_dir)
+
+def add_span(name, start, end, **args):
+    if not enabled or trace_name is None:
+        return
+    checkpoint.append(f'trace-{trace_name}', {
+        'name': name,
+        'ph': 'X',
+        'ts': round(start * 1e6),
+        'dur': round((end - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': threading.get_native_id(),
+        'args': args,
+    }, trace_dir)
+
+@contextlib.contextmanager
+def span(name, **args):
+    span_start = now()
+    try:
+        yield
+    finally:
+        add_span(name, span_start, now(), **args)
+
+def get_percentile(durations, percentile):
+    # nearest rank of sorted durations
+    return durations[max(0, math.ceil(percentile / 100 * len(durations)) - 1)]
+
+def get_summary(events):
+    durations = {}
+    for event in events:
+        durations.setdefault(event['name'], []).append(event['dur'] / 1e6)
+    summary = {}
+    for name, phase_durations in durations.items():
+        phase_durations.sort()
+        summary[name] = {
+            'count': len(phase_durations),
+            'total': round(sum(phase_durations), 2),
+            'p50': round(get_percentile(phase_durations, 50), 2),
+            'p90': round(get_percentile(phase_durations, 90), 2),
+            'p99': round(get_percentile(phase_durations, 99), 2),
+            'max': round(phase_durations[-1], 2),
+        }
+    return summary
+
+def print_summary(summary):
+    print(f"{'Phase':<24}{'count':>8}{'total [s]':>12}{'p50 [s]':>10}{'p90 [s]':>10}{'p99 [s]':>10}{'max [s]':>10}")
+    for name, phase in sorted(summary.items(), key=lambda item: item[1]['total'], reverse=True):
+        print(f"{name:<24}{phase['count']:>8}{phase['total']:>12.2f}{phase['p50']:>10.2f}{phase['p90']:>10.2f}{phase['p99']:>10.2f}{phase['max']:>10.2f}")
+
+def finish(directory='artifacts'):
+    # artifacts/trace-<name>.json and the summary in artifacts/results/trace-summary-<name>.json
+    if not enabled or trace_name is None:
+        return
+    events = checkpoint.load(f'trace-{trace_name}', directory)
+    if len(events) == 0:
+        return
+    origin = min(event['ts'] for event in events)
+    for event in events:
+        event['ts'] -= origin
+    with open(os.path.join(directory, f'trace-{trace_name}.json'), 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    summary = get_summary(events)
+    os.makedirs(os.path.join(directory, 'results'), exist_ok=True)
+    with open(os.path.join(directory, 'results', f'trace-summary-{trace_name}.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    print_summary(summary)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Moves an artifacts directory between jobs as a manifest plus content-addressed
+# blobs, so that files the remote already has (e.g. from the previous night) are
+# neither uploaded nor downloaded again.
+#
+#   transfer.py upload <directory> <remote> <name>
+#   transfer.py download <remote> <name> <directory> [--lazy]
+#   transfer.py gc <remote> <retention in days>
+#
+# <remote> is either a gs:// bucket or a local directory standing in for one;
+# manifests are kept in <remote>/<name>/manifest.json, blobs in <remote>/blobs/.
+# With --lazy only the top-level files are downloaded, the board directories are
+# fetched later with fetch() for the boards which are actually simulated.
+# The blobs outlive the manifests, which are deleted with the job artifacts, and
+# are dropped by gc (run by the results job) once no manifest refers to them and
+# they were uploaded more than the retention ago; one needed again is uploaded again.
+
+import datetime
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cache
+
+manifest_name = 'manifest.json'
+# local blob store the downloaded files are linked from
+artifact_store = cache.BlobStore(os.getenv('ARTIFACT_STORE')) if os.getenv('ARTIFACT_STORE') else None
+
+class DirectoryRemote:
+    def __init__(self, path):
+        self.path = path
+
+    def missing(self, names):
+        return [name for name in names if not os.path.exists(os.path.join(self.path, name))]
+
+    def put(self, files):
+        for name, filename in files.items():
+            dest = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(filename, dest + '.tmp')
+            os.replace(dest + '.tmp', dest)
+
+    def get(self, files):
+        for name, filename in files.items():
+            shutil.copyfile(os.path.join(self.path, name), filename)
+
+    def manifests(self):
+        return [os.path.relpath(filename, self.path) for filename in glob.glob(f'{self.path}/**/{manifest_name}', recursive=True)]
+
+    def blobs(self):
+        # name and upload time of every blob
+        blobs_dir = os.path.join(self.path, 'blobs')
+        if not os.path.isdir(blobs_dir):
+            return {}
+        return {f'blobs/{blob}': os.path.getmtime(os.path.join(blobs_dir, blob)) for blob in os.listdir(blobs_dir)}
+
+    def delete(self, names):
+        for name in names:
+            os.remove(os.path.join(self.path, name))
+
+class GsutilRemote:
+    batch_size = 500
+
+    def __init__(self, path):
+        self.path = path.rstrip('/')
+
+    def missing(self, names):
+        existing = set()
+        names = list(names)
+        for i in range(0, len(names), self.batch_size):
+            urls = [f'{self.path}/{name}' for name in names[i:i + self.batch_size]]
+            # prints the objects that exist and fails for the others
+            ls = subprocess.run(['gsutil', '-m', 'ls'] + urls, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            existing.update(ls.stdout.split())
+        return [name for name in names if f'{self.path}/{name}' not in existing]
+
+    def put(self, files):
+        # upload the files of each remote directory in one gsutil call; it names
+        # the objects after the local files, so they are linked under the
+        # remote names first
+        directories = {}
+        for name, filename in files.items():
+            directories.setdefault(os.path.dirname(name), {})[os.path.basename(name)] = filename
+        for directory, directory_files in directories.items():
+            with tempfile.TemporaryDirectory(dir='.') as tmp:
+                for base_name, filename in directory_files.items():
+                    try:
+                        os.link(filename, os.path.join(tmp, base_name))
+                    except OSError:
+                        shutil.copyfile(filename, os.path.join(tmp, base_name))
+                filenames = '\n'.join(os.path.join(tmp, base_name) for base_name in directory_files)
+                destination = f'{self.path}/{directory}/' if directory != '' else f'{self.path}/'
+                subprocess.run(['gsutil', '-m', '-q', 'cp', '-I', destination], input=filenames, text=True, check=True)
+
+    def get(self, files):
+        # download all blobs in one gsutil call, they are named after their hash
+        with tempfile.TemporaryDirectory(dir='.') as tmp:
+            urls = '\n'.join(f'{self.path}/{name}' for name in files)
+            subprocess.run(['gsutil', '-m', '-q', 'cp', '-I', tmp], input=urls, text=True, check=True)
+            for name, filename in files.items():
+                shutil.move(os.path.join(tmp, os.path.basename(name)), filename)
+
+    def manifests(self):
+        ls = subprocess.run(['gsutil', 'ls', f'{self.path}/**/{manifest_name}'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return [url[len(self.path) + 1:] for url in ls.stdout.split()]
+
+    def blobs(self):
+        # name and upload time of every blob, from lines like
+        # "  1234  2022-09-09T03:00:00Z  gs://bucket/blobs/<hash>"
+        ls = subprocess.run(['gsutil', 'ls', '-l', f'{self.path}/blobs/'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        blobs = {}
+        for line in ls.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[2].startswith(f'{self.path}/blobs/'):
+                uploaded = datetime.datetime.strptime(fields[1], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+                blobs[fields[2][len(self.path) + 1:]] = uploaded.timestamp()
+        return blobs
+
+    def delete(self, names):
+        if len(names) > 0:
+            urls = '\n'.join(f'{self.path}/{name}' for name in names)
+            subprocess.run(['gsutil', '-m', '-q', 'rm', '-I'], input=urls, text=True, check=True)
+
+def open_remote(location):
+    if location.startswith('gs://'):
+        return GsutilRemote(location)
+    return DirectoryRemote(location)
+
+def get_board_manifests(directory):
+    # hashes build.py already computed for the files it placed in the board directories
+    entries = {}
+    for board_dir in os.listdir(directory):
+        board_manifest = os.path.join(directory, board_dir, f'{board_dir}-manifest.json')
+        if os.path.exists(board_manifest):
+            with open(board_manifest) as f:
+                for file_name, entry in json.load(f).items():
+                    entries[f'{board_dir}/{file_name}'] = entry
+    return entries
+
+def get_manifest(directory):
+    # hash and size of every file in the directory; files which didn't change
+    # since the last manifest or which build.py already hashed aren't read again
+    manifest_filename = os.path.join(directory, manifest_name)
+    known = get_board_manifests(directory)
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            known.update(json.load(f))
+
+    manifest = {}
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            filename = os.path.join(root, file_name)
+            path = os.path.relpath(filename, directory)
+            if path == manifest_name:
+                continue
+            stat = os.stat(filename)
+            entry = known.get(path)
+            if entry is not None and entry['size'] == stat.st_size and entry.get('mtime', stat.st_mtime) == stat.st_mtime:
+                digest = entry['hash']
+            else:
+                digest = cache.hash_file(filename)
+            manifest[path] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    return manifest
+
+def write_manifest(directory):
+    manifest = get_manifest(directory)
+    with open(os.path.join(directory, manifest_name), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def upload(directory, location, name):
+    remote = open_remote(location)
+    manifest = write_manifest(directory)
+    blobs = {}
+    for path, entry in manifest.items():
+        blobs.setdefault(f"blobs/{entry['hash']}", os.path.join(directory, path))
+
+    missing = remote.missing(blobs)
+    remote.put({blob: blobs[blob] for blob in missing})
+    remote.put({f'{name}/{manifest_name}': os.path.join(directory, manifest_name)})
+    print(f"Uploaded {len(missing)} of {len(blobs)} blobs ({sum(os.path.getsize(blobs[blob]) for blob in missing)} bytes)")
+
+def fetch(location, directory, paths):
+    # bring the given manifest paths into the directory, skipping those that
+    # are already there and using the local blob store where possible
+    with open(os.path.join(directory, manifest_name)) as f:
+        manifest = json.load(f)
+
+    to_download = {}
+    for path in paths:
+        entry = manifest[path]
+        filename = os.path.join(directory, path)
+        if os.path.exists(filename) and os.path.getsize(filename) == entry['size'] and cache.hash_file(filename) == entry['hash']:
+            continue
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if artifact_store is not None and artifact_store.has(entry['hash']):
+            artifact_store.link_blob(entry['hash'], filename)
+            continue
+        to_download.setdefault(f"blobs/{entry['hash']}", []).append(filename)
+
+    if len(to_download) > 0:
+        with tempfile.TemporaryDirectory(dir=directory) as tmp:
+            downloaded = {blob: os.path.join(tmp, os.path.basename(blob)) for blob in to_download}
+            open_remote(location).get(downloaded)
+            for blob, filenames in to_download.items():
+                for filename in filenames:
+                    if artifact_store is not None:
+                        artifact_store.link_blob(artifact_store.add(downloaded[blob], os.path.basename(blob)), filename)
+                    else:
+                        shutil.copyfile(downloaded[blob], filename)
+    return len(to_download)
+
+def download(location, name, directory, lazy=False):
+    os.makedirs(directory, exist_ok=True)
+    open_remote(location).get({f'{name}/{manifest_name}': os.path.join(directory, manifest_name)})
+    with open(os.path.join(directory, manifest_name)) as f:
+        manifest = json.load(f)
+
+    paths = [path for path in manifest if not lazy or '/' not in path]
+    downloaded = fetch(location, directory, paths)
+    print(f"Downloaded {downloaded} blobs, {len(paths)} of {len(manifest)} files requested")
+
+def gc(location, retention_days):
+    remote = open_remote(location)
+    referenced = set()
+    with tempfile.TemporaryDirectory(dir='.') as tmp:
+        for i, name in enumerate(remote.manifests()):
+            filename = os.path.join(tmp, f'{i}.json')
+            remote.get({name: filename})
+            with open(filename) as f:
+                referenced.update(f"blobs/{entry['hash']}" for entry in json.load(f).values())
+
+    uploaded_before = time.time() - retention_days * 24 * 60 * 60
+    blobs = remote.blobs()
+    expired = [blob for blob, uploaded in blobs.items() if blob not in referenced and uploaded < uploaded_before]
+    remote.delete(expired)
+    print(f"Deleted {len(expired)} of {len(blobs)} blobs, {len(referenced)} are referenced by manifests")
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == 'upload':
+        upload(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) in (5, 6) and sys.argv[1] == 'download':
+        download(sys.argv[2], sys.argv[3], sys.argv[4], '--lazy' in sys.argv[5:])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'gc':
+        gc(sys.argv[2], float(sys.argv[3]))
+    else:
+        print(f"usage: {sys.argv[0]} upload <directory> <remote> <name>")
+        print(f"       {sys.argv[0]} download <remote> <name> <directory> [--lazy]")
+        print(f"       {sys.argv[0]} gc <remote> <retention in days>")
+        sys.exit(1)